@@ -1,124 +1,140 @@
+import hashlib
 import logging
-from collections import defaultdict
-import datetime as dt
+import multiprocessing
+import os
+import sys
+from concurrent.futures import ProcessPoolExecutor
 import json
+import matplotlib
+# Figures are only saved to files, which also works in the processes that render them
+matplotlib.use('Agg')
 from matplotlib import pyplot as plt
 import matplotlib.dates as mdates
+import numpy as np
 import pandas as pd
+import columnar_cache
 import database
-from misc.config import config
-
-
-def get_state(msm_results, monitoring_target, details=True, figure=True, groundtruth=False):
-    df = pd.DataFrame(msm_results,
-                      columns=['msm_id', 'monitoring_goal', 'query_type', 'target', 'ts', 'vp', 'vals'])
+from misc.config import config, get_default_zone, get_zone_section
+from misc import profiling
+from misc.tools import RETURN_CODE_NAMES
+
+plot_pool = None
+figure_cache = None
+# (path, content hash, future) of the figures that are rendered in the process pool
+pending_figures = []
+
+
+@profiling.timed('analysis.total')
+def get_state(msm_ids, start_date, stop_date, monitoring_target, query_type, details=True, figure=True,
+              groundtruth=False, json_format='json', output=None, zone=None):
+    """Analyzes the stored results of the given measurements of a zone between start_date and stop_date (as
+    timestamps). Without zone, the zone of [ROLLOVER] is analyzed.
+
+    With details, the state is written as JSON (json_format 'json' or 'ndjson') to output or stdout.
+    """
+    if len(msm_ids) == 0:
+        logging.warning('No measurements found. Abort')
+        return
 
-    df['ts_dt'] = df['ts'].apply(lambda x: dt.datetime.fromtimestamp(x, dt.UTC))
-    df = pd.merge(df,
-                  df['vals'].apply(lambda x: pd.Series(index=json.loads(x).keys(), data=json.loads(x).values())),
-                  left_index=True, right_index=True)
+    if zone is None:
+        zone = get_default_zone()
 
     if monitoring_target == 'propdelay':
-        analyze_propdelay(df, details, figure)
+        analyze_propdelay(msm_ids, start_date, stop_date, query_type, zone, details, figure, json_format, output)
 
     elif monitoring_target == 'pubdelay':
-        analyze_pubdelay(df, details, figure)
+        analyze_pubdelay(msm_ids, start_date, stop_date, query_type, zone, details, figure, json_format, output)
 
     elif monitoring_target == 'trustchain':
-        analyze_trustchain(df, details, figure, groundtruth)
+        analyze_trustchain(msm_ids, start_date, stop_date, zone, details, figure, groundtruth, json_format, output)
 
 
-def analyze_propdelay(df, details, figure):
-    record = 'DNSKEY'
+def count_vps(msm_ids, monitoring_goal, query_type, zone, start_date, stop_date):
+    """Counts the distinct VPs per time bin that see a key tag, and the distinct VPs per time bin in total.
 
-    if 'flags' not in df.columns:
-        df['flags'] = 'DS'
-        record = 'DS'
+    The counting is done by the DB, closed time bins come from its rollups. Returns the DNS record type and two Series,
+    indexed by (ts_dt, target, flags, key_tag) and by (ts_dt, target, flags). The flags of DS records are 'DS'.
+    """
+    key_counts, total_counts = columnar_cache.get_vp_counts(msm_ids, monitoring_goal, query_type, zone, start_date,
+                                                            stop_date)
 
-    df_state = (df
-                .set_index('ts_dt')
-                .groupby(pd.Grouper(freq=config['TTLS'][f'ttl_{df["query_type"].iloc[0]}'] + 's'))
-                .apply(lambda x: x.groupby(['target', 'flags', 'key_tag'])['vp'].nunique())
-                )
+    with profiling.span('analysis.aggregate'):
+        df_state = key_counts.rename(columns={'bin': 'ts_dt', 'vps': 'vp'})
+        df_state_sum = total_counts.rename(columns={'bin': 'ts_dt', 'vps': 'vp'})
 
-    if type(df_state) == pd.Series:
-        df_state = (df_state
-                    .reset_index()
-                    .set_index(['ts_dt', 'key_tag', 'flags', 'target'])
-                    .unstack()
-                    .unstack()
-                    .unstack()['vp']
-                    .dropna(axis=1, how='all'))
+        record = 'DNSKEY'
+        if df_state['flags'].isna().all():
+            record = 'DS'
 
-    df_state_sum = (df
-                    .set_index('ts_dt')
-                    .groupby(pd.Grouper(freq=config['TTLS'][f'ttl_{df["query_type"].iloc[0]}'] + 's'))
-                    .apply(lambda x: x.groupby(['target', 'flags'])['vp'].nunique())
-                    )
+        for df in (df_state, df_state_sum):
+            df['ts_dt'] = pd.to_datetime(df['ts_dt'], unit='s', utc=True)
+            df['flags'] = 'DS' if record == 'DS' else df['flags'].astype('int64')
 
-    if figure:
-        plot_propdelay(df_state, record)
+        return (record,
+                df_state.astype({'key_tag': 'int64'}).set_index(['ts_dt', 'target', 'flags', 'key_tag'])['vp'],
+                df_state_sum.set_index(['ts_dt', 'target', 'flags'])['vp'])
 
-    if details:
-        print(get_json_pubdelay_propdelay(df_state.fillna(0), df_state_sum.fillna(0)))
 
+def analyze_propdelay(msm_ids, start_date, stop_date, query_type, zone, details, figure, json_format='json',
+                      output=None):
+    record, df_state, df_state_sum = count_vps(msm_ids, 'propdelay', query_type, zone, start_date, stop_date)
 
-def analyze_pubdelay(df, details, figure):
-    record = 'DNSKEY'
+    df_state = (df_state
+                .unstack(['target', 'flags', 'key_tag'])
+                .sort_index(axis=1)
+                .dropna(axis=1, how='all'))
 
-    if 'flags' not in df.columns:
-        df['flags'] = 'DS'
-        record = 'DS'
+    if figure:
+        with profiling.span('analysis.plot'):
+            plot_propdelay(df_state, record, zone)
+            wait_for_figures()
 
-    df_state = (df
-                .set_index('ts_dt')
-                .groupby(pd.Grouper(freq=config['MEASUREMENTS'][f'msm_frequency_publication_delay'] + 's'))
-                .apply(lambda x: x.groupby(['target', 'flags', 'key_tag'])['vp'].nunique())
-                )
+    if details:
+        write_json(iter_json_pubdelay_propdelay(df_state.fillna(0), df_state_sum.fillna(0)), json_format, output)
 
-    if type(df_state) == pd.Series:
-        df_state = (df_state
-                    .reset_index()
-                    .set_index(['ts_dt', 'key_tag', 'flags', 'target'])
-                    .unstack()
-                    .unstack()
-                    .unstack()['vp']
-                    .dropna(axis=1, how='all'))
 
-    df_state_sum = (df
-                    .set_index('ts_dt')
-                    .groupby(pd.Grouper(freq=config['MEASUREMENTS'][f'msm_frequency_publication_delay'] + 's'))
-                    .apply(lambda x: x.groupby(['target', 'flags'])['vp'].nunique())
-                    )
+def analyze_pubdelay(msm_ids, start_date, stop_date, query_type, zone, details, figure, json_format='json',
+                     output=None):
+    record, df_state, df_state_sum = count_vps(msm_ids, 'pubdelay', query_type, zone, start_date, stop_date)
 
-    if type(df_state_sum) == pd.Series:
-        df_state_sum = (df_state_sum
-                        .reset_index()
-                        .set_index(['ts_dt', 'flags', 'target'])
-                        .unstack()
-                        .unstack()['vp']
-                        .dropna(axis=1, how='all'))
+    df_state = (df_state
+                .unstack(['target', 'flags', 'key_tag'])
+                .sort_index(axis=1)
+                .dropna(axis=1, how='all'))
+
+    df_state_sum = (df_state_sum
+                    .unstack(['target', 'flags'])
+                    .sort_index(axis=1)
+                    .dropna(axis=1, how='all'))
 
     if figure:
         nameservers = (df_state.columns.levels[0].tolist())
 
-        plot_pubdelay(df_state, record, nameservers)
-        for ns in nameservers:
-            plot_pubdelay(df_state, record, [ns])
+        with profiling.span('analysis.plot'):
+            plot_pubdelay(df_state, record, nameservers, zone)
+            for ns in nameservers:
+                plot_pubdelay(df_state, record, [ns], zone)
+            wait_for_figures()
 
     if details:
-        print(get_json_pubdelay_propdelay(df_state.fillna(0), df_state_sum.fillna(0)))
+        write_json(iter_json_pubdelay_propdelay(df_state.fillna(0), df_state_sum.fillna(0)), json_format, output)
+
 
+def analyze_trustchain(msm_ids, start_date, stop_date, zone, details, figure, groundtruth=False, json_format='json',
+                       output=None):
+    counts = columnar_cache.get_return_code_counts(msm_ids, zone, start_date, stop_date)
 
-def analyze_trustchain(df, details, figure, groundtruth=False):
-    df_state = (df
-                .set_index('ts_dt')
-                .groupby(pd.Grouper(freq=str(int(config['TTLS']['ttl_dnskey']) * 2) + 's'))
-                .apply(lambda x: x.groupby(['target', 'vp', 'return_code', 'query_type'])['ts'].count())
-                .unstack()
-                .unstack()
-                .fillna(0)
-                )
+    with profiling.span('analysis.aggregate'):
+        df_state = counts.rename(columns={'bin': 'ts_dt', 'responses': 'ts'})
+        df_state['ts_dt'] = pd.to_datetime(df_state['ts_dt'], unit='s', utc=True)
+        df_state['return_code'] = df_state['return_code'].map(RETURN_CODE_NAMES).fillna(df_state['return_code'])
+
+        df_state = (df_state
+                    .set_index(['ts_dt', 'target', 'vp', 'return_code', 'query_type'])['ts']
+                    .unstack()
+                    .unstack()
+                    .fillna(0)
+                    )
 
     if df_state.shape[1] == 1:
         logging.warning('Not enough trustchain mesurements. Abort')
@@ -194,61 +210,202 @@ def analyze_trustchain(df, details, figure, groundtruth=False):
     df_state_v6 = df_state_v6.fillna(0)
 
     if details:
-        print(get_json_trustchain(df_state_v4, df_state_v6))
+        write_json(iter_json_trustchain(df_state_v4, df_state_v6), json_format, output)
 
     if figure:
-        plot_trustchain(df_state_v4, df_state_v6)
+        with profiling.span('analysis.plot'):
+            plot_trustchain(df_state_v4, df_state_v6, zone)
+            wait_for_figures()
+
+
+def get_shares(probes, totals):
+    """Returns the probes as share (in percent) of the totals, rounded to two decimals."""
+    with np.errstate(divide='ignore', invalid='ignore'):
+        return np.round(probes / totals * 100, 2)
+
+
+def iter_json_pubdelay_propdelay(df_state, df_state_sum):
+    """Yields (timestamp, state) of every time bin, with the probes that see a key tag and their share of all probes
+    that see a key of the same type, per target and key type."""
+    if isinstance(df_state_sum, pd.Series):
+        df_state_sum = df_state_sum.unstack(['target', 'flags'])
+
+    # Only ZSKs, KSKs and DS records are reported
+    columns = [column for column in df_state.columns if column[1] in (256, 257, 'DS')]
+    probes = df_state[columns]
+    totals = (df_state_sum
+              .reindex(index=probes.index,
+                       columns=pd.MultiIndex.from_tuples([column[:2] for column in columns]))
+              .fillna(0))
+
+    shares = get_shares(probes.to_numpy(), totals.to_numpy())
+
+    for ts_dt, probes_row, shares_row in zip(probes.index, probes.to_numpy().tolist(), shares.tolist()):
+        state = {}
+        for (target, keytype, keytag), vps, share in zip(columns, probes_row, shares_row):
+            state.setdefault(target, {}).setdefault(keytype, {})[keytag] = {'probes': vps, 'share': share}
+
+        yield int(ts_dt.timestamp()), state
+
+
+def iter_json_trustchain(df_state_v4, df_state_v6):
+    """Yields (timestamp, state) of every time bin, with the number and share of VPs per validation state and IP
+    version."""
+    states = ['secure', 'insecure', 'bogus']
+    frames = []
+    for df_state in (df_state_v4, df_state_v6.reindex(df_state_v4.index)):
+        vps = df_state[states].to_numpy(dtype='float64')
+        frames.append((vps.astype('int64').tolist(), get_shares(vps, vps.sum(axis=1, keepdims=True)).tolist()))
+
+    for idx, ts_dt in enumerate(df_state_v4.index):
+        state = {}
+        for ipv, (vps, shares) in zip(['4', '6'], frames):
+            state[ipv] = {s: {'probes': vps[idx][i], 'share': shares[idx][i]} for i, s in enumerate(states)}
+
+        yield int(ts_dt.timestamp()), state
+
+
+@profiling.timed('analysis.json')
+def write_json(states, json_format='json', output=None):
+    """Writes the (timestamp, state) of every time bin to output (a path) or stdout while they are generated.
 
+    With the 'json' format, all bins form a single object keyed by timestamp. With 'ndjson', every bin is written
+    as an object of its own on a separate line, so that the output can be tailed.
+    """
+    f = open(output, 'w') if output is not None else sys.stdout
 
-def get_json_pubdelay_propdelay(df_state, df_state_sum):
-    msm_json = defaultdict(lambda: defaultdict(
-        lambda: defaultdict(
-            lambda: defaultdict(
-                lambda: defaultdict(
-                    lambda: defaultdict(float)
-                )))))
+    try:
+        if json_format == 'ndjson':
+            for ts, state in states:
+                f.write(json.dumps({ts: state}) + '\n')
+        else:
+            f.write('{')
+            for idx, (ts, state) in enumerate(states):
+                if idx > 0:
+                    f.write(', ')
+                f.write(f'{json.dumps(str(ts))}: {json.dumps(state)}')
+            f.write('}\n')
+
+    finally:
+        if output is not None:
+            f.close()
+
+
+def get_figures_dir(zone):
+    """Returns the directory of the figures of a zone. Figures of other zones than the one of [ROLLOVER] are stored in
+    a subdirectory named after the zone."""
+    if zone == get_default_zone():
+        return f'./{config["OUTPUT"]["figures"]}'
+
+    return f'./{config["OUTPUT"]["figures"]}/{zone}'
+
+
+def get_figure_cache_path():
+    return f'./{config["OUTPUT"]["figures"]}/.figure_cache.json'
+
+
+def load_figure_cache():
+    """Returns the content hashes of the figures of the last run, by path."""
+    global figure_cache
+
+    if figure_cache is None:
+        try:
+            with open(get_figure_cache_path()) as f:
+                figure_cache = json.load(f)
+        except (OSError, ValueError):
+            figure_cache = {}
+
+    return figure_cache
+
+
+def get_plot_workers():
+    # More processes than CPUs only add the start-up time of the processes
+    return min(config['OUTPUT'].getint('plot_workers', fallback=4), os.cpu_count() or 1)
+
+
+def get_plot_pool():
+    """Returns the process pool that renders figures. The pool is created on first use."""
+    global plot_pool
+
+    if plot_pool is None:
+        plot_pool = ProcessPoolExecutor(max_workers=get_plot_workers(),
+                                        mp_context=multiprocessing.get_context('spawn'))
+
+    return plot_pool
+
+
+def render_figure(path, title, ylabel, lines):
+    """Draws lines (Series with the keyword arguments of ax.plot) into a figure and saves it to path."""
+    fig, ax = plt.subplots()
+
+    ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
 
-    for target in df_state.columns.levels[0].tolist():
-        for keytype in [256, 257, 'DS']:
-            if keytype in df_state[target].columns.levels[0]:
-                for keytag in df_state[target][keytype].columns:
-                    for ts_dt, vps in df_state[target][keytype][keytag].items():
-                        msm_json[int(ts_dt.timestamp())][target][keytype][keytag]['probes'] = vps
+    for series, kwargs in lines:
+        ax.plot(series, **kwargs)
 
-                        share = vps / df_state_sum.loc[ts_dt][target][keytype] * 100
-                        msm_json[int(ts_dt.timestamp())][target][keytype][keytag]['share'] = round(share, 2)
+    ax.set_title(title)
+    ax.legend()
+    ax.set_ylim(0, 105)
+    ax.set_ylabel(ylabel)
 
-    return json.dumps(msm_json)
+    fig.tight_layout()
+    fig.autofmt_xdate()
+    fig.savefig(path)
+    plt.close(fig)
 
 
-def get_json_trustchain(df_state_v4, df_state_v6):
-    msm_json = defaultdict(lambda: defaultdict(
-        lambda: defaultdict(
-            lambda: defaultdict(
-                lambda: defaultdict(float)
-            ))))
+def get_figure_digest(title, ylabel, lines):
+    """Returns a content hash of a figure that is the same in every run for the same data. Pickles of pandas objects
+    are not, so the values and index of every line are hashed with pandas."""
+    digest = hashlib.sha256(json.dumps([title, ylabel, [(len(series), kwargs) for series, kwargs in lines]],
+                                       sort_keys=True, default=str).encode())
 
-    for ts_dt in df_state_v4.index:
-        for ipv in ["4", "6"]:
-            for state in ["secure", "insecure", "bogus"]:
-                vps = 0
-                all_vps = 0
-                if ipv == "4":
-                    vps = df_state_v4.loc[ts_dt, state]
-                    all_vps = df_state_v4.loc[ts_dt].sum()
-                elif ipv == "6":
-                    vps = df_state_v6.loc[ts_dt, state]
-                    all_vps = df_state_v6.loc[ts_dt].sum()
+    for series, _ in lines:
+        digest.update(pd.util.hash_pandas_object(series, index=True).values.tobytes())
 
-                msm_json[int(ts_dt.timestamp())][ipv][state]['probes'] = int(vps)
-                share = vps / all_vps * 100
-                msm_json[int(ts_dt.timestamp())][ipv][state]['share'] = round(share, 2)
+    return digest.hexdigest()
 
-    return json.dumps(msm_json)
 
+def submit_figure(path, title, ylabel, lines):
+    """Renders a figure, unless the figure at path already shows the same data.
 
-def plot_pubdelay(df_state, record, nameservers):
-    ips_dict = get_ip_to_domain_name_dict()
+    With more than one 'plot_workers' (and CPU), the figure is rendered in a process pool. wait_for_figures() waits until
+    every submitted figure has been saved.
+    """
+    digest = get_figure_digest(title, ylabel, lines)
+
+    if load_figure_cache().get(path) == digest and os.path.exists(path):
+        logging.debug(f'Figure {path} is up to date')
+        profiling.count('analysis.figures_unchanged')
+        return
+
+    profiling.count('analysis.figures_rendered')
+
+    if get_plot_workers() > 1:
+        pending_figures.append((path, digest, get_plot_pool().submit(render_figure, path, title, ylabel, lines)))
+    else:
+        render_figure(path, title, ylabel, lines)
+        figure_cache[path] = digest
+
+
+def wait_for_figures():
+    """Waits for the figures that are rendered in the process pool and stores the content hashes of the figures."""
+    for path, digest, future in pending_figures:
+        try:
+            future.result()
+            figure_cache[path] = digest
+        except Exception as e:
+            logging.error(f'Rendering {path} failed: {e}')
+
+    pending_figures.clear()
+
+    if figure_cache is not None:
+        with open(get_figure_cache_path(), 'w') as f:
+            json.dump(figure_cache, f)
+
+
+def plot_pubdelay(df_state, record, nameservers, zone):
+    ips_dict = get_ip_to_domain_name_dict(zone)
 
     if record == 'DS':
         keytypes = ['DS']
@@ -256,41 +413,37 @@ def plot_pubdelay(df_state, record, nameservers):
         keytypes = [256, 257]
 
     for key_type in keytypes:
-        fig, ax = plt.subplots()
-
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
+        lines = []
 
         for nameserver in nameservers:
             if key_type in df_state[nameserver].columns.levels[0].tolist():
                 df_zsk_ksk = df_state[nameserver][key_type]
                 df_zsk_ksk = df_zsk_ksk.divide(df_zsk_ksk.max(1), axis=0) * 100
                 for key_tag in df_zsk_ksk.columns:
-                    ax.plot(df_zsk_ksk[key_tag], label=f'{ips_dict[nameserver]} ({nameserver}): {key_tag}', marker='o')
+                    lines.append((df_zsk_ksk[key_tag],
+                                  {'label': f'{ips_dict[nameserver]} ({nameserver}): {key_tag}', 'marker': 'o'}))
 
         key_type_txt = ''
+        title = ''
         if key_type == 256:
             key_type_txt = 'ZSK'
-            ax.set_title(f"ZSKs seen at name servers")
+            title = f"ZSKs seen at name servers"
         elif key_type == 257:
             key_type_txt = 'KSK'
-            ax.set_title(f"KSKs seen at name servers")
+            title = f"KSKs seen at name servers"
         elif key_type == 'DS':
             key_type_txt = 'DS'
-            ax.set_title(f"DS seen at name servers")
-
-        ax.legend()
-        ax.set_ylim(0, 105)
-        ax.set_ylabel('Seen by probes (%)')
+            title = f"DS seen at name servers"
 
-        fig.tight_layout()
-        fig.autofmt_xdate()
         if len(nameservers) > 1:
-            fig.savefig(f'./{config["OUTPUT"]["figures"]}/pubdelay_{key_type_txt}.png')
+            path = f'{get_figures_dir(zone)}/pubdelay_{key_type_txt}.png'
         else:
-            fig.savefig(f'./{config["OUTPUT"]["figures"]}/servers/pubdelay_{key_type_txt}_{ips_dict[nameservers[0]].replace('.', '_')}_{nameservers[0]}.png')
+            path = f'{get_figures_dir(zone)}/servers/pubdelay_{key_type_txt}_{ips_dict[nameservers[0]].replace('.', '_')}_{nameservers[0]}.png'
 
+        submit_figure(path, title, 'Seen by probes (%)', lines)
 
-def plot_propdelay(df_state, record):
+
+def plot_propdelay(df_state, record, zone):
     ipvs = (df_state.columns.levels[0].tolist())
 
     if record == 'DS':
@@ -299,9 +452,7 @@ def plot_propdelay(df_state, record):
         keytypes = [256, 257]
 
     for key_type in keytypes:
-        fig, ax = plt.subplots()
-
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
+        lines = []
 
         for ipv in ipvs:
             if key_type in df_state[ipv].columns.levels[0].tolist():
@@ -311,59 +462,47 @@ def plot_propdelay(df_state, record):
                     linestyle = '-'
                     if ipv == '4':
                         linestyle = '--'
-                    ax.plot(df_zsk_ksk[key_tag], label=f'IPv{ipv}: {key_tag}', marker='o', linestyle=linestyle)
+                    lines.append((df_zsk_ksk[key_tag],
+                                  {'label': f'IPv{ipv}: {key_tag}', 'marker': 'o', 'linestyle': linestyle}))
 
         key_type_txt = ''
+        title = ''
         if key_type == 256:
             key_type_txt = 'ZSK'
-            ax.set_title(f"ZSKs seen at resolvers")
+            title = f"ZSKs seen at resolvers"
         elif key_type == 257:
             key_type_txt = 'KSK'
-            ax.set_title(f"KSKs seen at resolvers")
+            title = f"KSKs seen at resolvers"
         elif key_type == 'DS':
             key_type_txt = 'DS'
-            ax.set_title(f"DS seen at resolvers")
+            title = f"DS seen at resolvers"
 
-        ax.legend()
-        ax.set_ylim(0, 105)
-        ax.set_ylabel('Seen by probes (%)')
+        submit_figure(f'{get_figures_dir(zone)}/propdelay_{key_type_txt}.png', title, 'Seen by probes (%)', lines)
 
-        fig.tight_layout()
-        fig.autofmt_xdate()
-        fig.savefig(f'./{config["OUTPUT"]["figures"]}/propdelay_{key_type_txt}.png')
 
-
-def plot_trustchain(df_state_v4, df_state_v6):
+def plot_trustchain(df_state_v4, df_state_v6, zone):
     state_style = {'secure': ['green', '-', 'o'],
                    'insecure': ['orange', '--', 's'],
                    'bogus': ['red', '-.', 'x']}
 
     for df_state, ipv in [[df_state_v4, 4], [df_state_v6, 6]]:
-        fig, ax = plt.subplots()
-
-        ax.xaxis.set_major_formatter(mdates.DateFormatter('%Y-%m-%d %H:%M'))
-
         df_state = df_state.divide(df_state.sum(1), axis=0) * 100
 
+        lines = []
         for state in df_state.columns:
-            ax.plot(df_state[state], label=state, color=state_style[state][0], linestyle=state_style[state][1],
-                    marker=state_style[state][2])
-
-        ax.legend()
-        ax.set_ylim(0, 105)
-        ax.set_ylabel('VPs (%)')
-        ax.set_title(f'State of resolvers (IPv{ipv})')
+            lines.append((df_state[state], {'label': state, 'color': state_style[state][0],
+                                            'linestyle': state_style[state][1], 'marker': state_style[state][2]}))
 
-        fig.tight_layout()
-        fig.autofmt_xdate()
-        fig.savefig(f'./{config["OUTPUT"]["figures"]}/trustchain_{ipv}.png')
+        submit_figure(f'{get_figures_dir(zone)}/trustchain_{ipv}.png', f'State of resolvers (IPv{ipv})',
+                      'VPs (%)', lines)
 
 
-def get_ip_to_domain_name_dict():
+def get_ip_to_domain_name_dict(zone):
     ips_dict = {}
     for relationship in ['CHILDREN', 'PARENTS']:
-        for ns in config[relationship]:
-            for ip in config[relationship][ns].split():
+        name_servers = get_zone_section(relationship, zone)
+        for ns in name_servers:
+            for ip in name_servers[ns].split():
                 ips_dict[ip.strip().replace(',', '')] = ns
 
     return ips_dict
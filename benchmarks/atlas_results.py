@@ -0,0 +1,161 @@
+"""Generates synthetic RIPE Atlas DNS results, including the wire-format abuf of every response.
+
+The results look like those of the measurements that rollover_mon.py creates: DNSKEY and DS queries to name servers
+(publication delay), DNSKEY and DS queries to the resolvers of the probes (propagation delay) and queries to a valid and
+a bogus domain name (trust chain). Keys are rolled over the time span of the results.
+"""
+import base64
+import random
+import struct
+
+TYPE_A = 1
+TYPE_DS = 43
+TYPE_DNSKEY = 48
+
+RCODE_NOERROR = 0
+RCODE_SERVFAIL = 2
+
+FLAGS_ZSK = 256
+FLAGS_KSK = 257
+ALGORITHM = 13
+
+# How a rollover progresses over the time span of the results:
+# 'stable': only the old key is published
+# 'publish': the new key is seen by more and more probes, next to the old key
+# 'withdraw': the old key is seen by less and less probes, the new key is published
+PHASES = ['stable', 'publish', 'withdraw']
+
+
+def encode_name(name):
+    wire = b''
+    for label in name.rstrip('.').split('.'):
+        if label:
+            wire += bytes([len(label)]) + label.encode('ascii')
+
+    return wire + b'\x00'
+
+
+def build_abuf(qname, qtype, answers, return_code=RCODE_NOERROR):
+    """Returns the base64 encoded DNS response with answers (a list of (type, rdata)) to a query of qname."""
+    header = struct.pack('!HHHHHH', 0, 0x8180 | return_code, 1, len(answers), 0, 0)
+    message = header + encode_name(qname) + struct.pack('!HH', qtype, 1)
+
+    for record_type, rdata in answers:
+        # The owner name points to the name in the question section
+        message += b'\xc0\x0c' + struct.pack('!HHIH', record_type, 1, 3600, len(rdata)) + rdata
+
+    return base64.b64encode(message).decode('ascii')
+
+
+def get_dnskey_rdata(flags, key):
+    return struct.pack('!HBB', flags, 3, ALGORITHM) + key
+
+
+def get_ds_rdata(key_tag):
+    return struct.pack('!HBB', key_tag, ALGORITHM, 2) + bytes(32)
+
+
+def get_key_tag(flags, key):
+    """Returns the key tag of a DNSKEY (RFC 4034, Appendix B)."""
+    rdata = get_dnskey_rdata(flags, key)
+    cnt = sum(rdata[0::2]) << 8
+    cnt += sum(rdata[1::2])
+
+    return ((cnt & 0xFFFF) + (cnt >> 16)) & 0xFFFF
+
+
+def make_keys(rng, rolled_flags):
+    """Returns the old ZSK and KSK and the new key of the rolled type, by (flags, 'old' or 'new')."""
+    return {(FLAGS_ZSK, 'old'): rng.randbytes(64),
+            (FLAGS_KSK, 'old'): rng.randbytes(64),
+            (rolled_flags, 'new'): rng.randbytes(64)}
+
+
+def get_published_keys(keys, rolled_flags, phase, sees_new_state):
+    """Returns (flags, key) of the published keys, as seen by a probe that either sees the new state of the phase or
+    not."""
+    published = [(flags, keys[(flags, 'old')]) for flags in [FLAGS_ZSK, FLAGS_KSK]]
+    new_key = (rolled_flags, keys[(rolled_flags, 'new')])
+
+    if phase == 'publish' and sees_new_state:
+        published.append(new_key)
+    elif phase == 'withdraw':
+        if sees_new_state:
+            published = [key for key in published if key[0] != rolled_flags]
+        published.append(new_key)
+
+    return published
+
+
+def generate(monitoring_goal, msm_id, probes, start_ts, stop_ts, interval, zone='example.nl.', target=None, af=4,
+             record='dnskey', query_type=None, rolled='zsk', phase='publish', seed=1):
+    """Yields the results of one measurement between start_ts and stop_ts.
+
+    Every probe reports once per interval, except for a few results that are missing. monitoring_goal is 'pubdelay',
+    'propdelay' or 'trustchain'. For publication delay, target is the address of the queried name server. For the trust
+    chain, query_type is 'valid' or 'bogus'.
+    """
+    if phase not in PHASES:
+        raise ValueError(f"Phase must be one of {', '.join(PHASES)}")
+
+    rng = random.Random(seed * 100003 + msm_id)
+    rolled_flags = FLAGS_ZSK if rolled == 'zsk' else FLAGS_KSK
+    keys = make_keys(rng, rolled_flags)
+    span = max(stop_ts - start_ts, 1)
+
+    for ts in range(start_ts, stop_ts, interval):
+        # Share of the probes that see the new state of the rollover
+        progress = (ts - start_ts) / span
+
+        for prb_id in range(1, probes + 1):
+            if rng.random() < 0.05:
+                continue
+
+            timestamp = ts + rng.randrange(0, max(interval - 20, 1))
+            sees_new_state = rng.random() < progress
+
+            if monitoring_goal == 'trustchain':
+                # Every fifth resolver does not validate and a few resolvers fail to resolve anything
+                validating = prb_id % 5 != 0
+                broken = prb_id % 17 == 0
+                if query_type == 'bogus':
+                    return_code = RCODE_SERVFAIL if validating else RCODE_NOERROR
+                    qname = 'servfail.nl.'
+                else:
+                    return_code = RCODE_SERVFAIL if broken else RCODE_NOERROR
+                    qname = 'www.' + zone
+
+                answers = [] if return_code else [(TYPE_A, bytes([192, 0, 2, prb_id % 250]))]
+                abuf = build_abuf(qname, TYPE_A, answers, return_code)
+
+            else:
+                published = get_published_keys(keys, rolled_flags, phase, sees_new_state)
+
+                if record == 'ds':
+                    # The parent publishes the DS records of the KSKs
+                    answers = [(TYPE_DS, get_ds_rdata(get_key_tag(flags, key)))
+                               for flags, key in published if flags == FLAGS_KSK]
+                    abuf = build_abuf(zone, TYPE_DS, answers)
+                else:
+                    answers = [(TYPE_DNSKEY, get_dnskey_rdata(flags, key)) for flags, key in published]
+                    abuf = build_abuf(zone, TYPE_DNSKEY, answers)
+
+            response = {'size': 100, 'abuf': abuf, 'ID': 0, 'ANCOUNT': len(answers), 'QDCOUNT': 1, 'NSCOUNT': 0,
+                        'ARCOUNT': 0, 'rt': round(rng.uniform(5, 50), 3)}
+
+            if monitoring_goal == 'pubdelay':
+                yield {'fw': 5080, 'msm_id': msm_id, 'prb_id': prb_id, 'timestamp': timestamp, 'af': af,
+                       'dst_addr': target, 'src_addr': '10.0.0.1', 'proto': 'UDP', 'result': response, 'type': 'dns',
+                       'from': '198.51.100.1'}
+            else:
+                # Some probes switch between several resolvers over time
+                resolver_id = (ts // interval) % 3 if prb_id % 7 == 0 else 0
+                if af == 4:
+                    resolver = f'10.{prb_id // 250 % 250}.{prb_id % 250}.{resolver_id + 1}'
+                else:
+                    resolver = f'2001:db8::{resolver_id}:{prb_id:x}'
+
+                yield {'fw': 5080, 'lts': 10, 'msm_id': msm_id, 'prb_id': prb_id, 'timestamp': timestamp,
+                       'resultset': [{'time': timestamp, 'lts': 10, 'subid': 1, 'submax': 1, 'dst_addr': resolver,
+                                      'af': af, 'src_addr': '10.0.0.1', 'proto': 'UDP', 'result': response}],
+                       'type': 'dns', 'from': '198.51.100.1'}
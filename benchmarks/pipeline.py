@@ -0,0 +1,190 @@
+"""Benchmarks the stages of the monitoring pipeline on synthetic RIPE Atlas results.
+
+For every number of probes, the results of a full set of measurements (publication delay, propagation delay and trust
+chain) are generated and run through the pipeline. Every stage is run twice in a temporary directory: once to measure
+its run time and once with tracemalloc to measure its peak memory. Run from the root of the repository:
+
+    python benchmarks/pipeline.py [--probes 100 1000 10000] [--hours 2] [--phase publish] [--rolled zsk]
+
+Throughput is given in results per second, i.e. the number of stored results that a stage processes.
+"""
+import argparse
+import logging
+import os
+import sys
+import tempfile
+import time
+import tracemalloc
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+sys.path.insert(0, REPO)
+
+from misc.config import config
+import atlas_results
+
+ZONE = 'example.nl.'
+CHILD = {'ns1.example.nl': ['192.0.2.1', '2001:db8::1']}
+PARENT = {'ns1.dns.nl': ['192.0.2.53']}
+
+# msm_id, monitoring goal, query type, target (as stored in the measurements table) and options of the generator
+MEASUREMENTS = [(1001, 'pubdelay', 'dnskey', '192.0.2.1', {'target': '192.0.2.1'}),
+                (1002, 'pubdelay', 'dnskey', '2001:db8::1', {'target': '2001:db8::1', 'af': 6}),
+                (1101, 'pubdelay', 'ds', '192.0.2.53', {'target': '192.0.2.53', 'record': 'ds'}),
+                (2001, 'propdelay', 'dnskey', '4', {}),
+                (2002, 'propdelay', 'dnskey', '6', {'af': 6}),
+                (2101, 'propdelay', 'ds', '4', {'record': 'ds'}),
+                (3001, 'trustchain', 'valid', '4', {'query_type': 'valid'}),
+                (3002, 'trustchain', 'valid', '6', {'query_type': 'valid', 'af': 6}),
+                (3003, 'trustchain', 'bogus', '4', {'query_type': 'bogus'}),
+                (3004, 'trustchain', 'bogus', '6', {'query_type': 'bogus', 'af': 6}),
+                ]
+
+# Monitoring goal and query type of every analysis
+ANALYSES = [('pubdelay', 'dnskey'), ('pubdelay', 'ds'), ('propdelay', 'dnskey'), ('propdelay', 'ds'),
+            ('trustchain', None)]
+
+
+def configure(work_dir):
+    """Points the config to a DB and figures directory in work_dir."""
+    config.read(os.path.join(REPO, 'config.ini.template'))
+
+    config['ROLLOVER']['zone'] = ZONE
+    config['DATABASE']['db_path'] = os.path.join(work_dir, 'rollover.db')
+    config['MEASUREMENTS']['trust_chain_valid'] = 'www.' + ZONE
+    config['OUTPUT']['loglevel'] = 'WARNING'
+    config['CHILDREN'] = {ns: ', '.join(ips) for ns, ips in CHILD.items()}
+    config['PARENTS'] = {ns: ', '.join(ips) for ns, ips in PARENT.items()}
+
+
+def get_interval(monitoring_goal, query_type):
+    import ripe_interface
+
+    return int(ripe_interface.get_measurement_interval(monitoring_goal, query_type, ZONE))
+
+
+def get_msm_ids(monitoring_goal, query_type):
+    return [msm_id for msm_id, goal, qtype, _, _ in MEASUREMENTS
+            if goal == monitoring_goal and (monitoring_goal == 'trustchain' or qtype == query_type)]
+
+
+def open_db(run_dir):
+    """Creates a new DB in run_dir with the measurements and makes it the DB of the pipeline."""
+    import database
+    import init_db
+
+    # init_db logs everything
+    logging.getLogger().setLevel(logging.WARNING)
+
+    os.makedirs(os.path.join(run_dir, 'figs', 'servers'))
+    os.chdir(run_dir)
+
+    # The connection of this thread belongs to the DB of the previous run
+    connection = getattr(database.connections, 'connection', None)
+    if connection is not None:
+        connection.close()
+        database.connections.connection = None
+
+    config['DATABASE']['db_path'] = os.path.join(run_dir, 'rollover.db')
+    config['OUTPUT']['figures'] = 'figs'
+    init_db.init_table()
+
+    connection = database.connect_db()
+    for msm_id, monitoring_goal, query_type, target, _ in MEASUREMENTS:
+        database.init_measurement(msm_id, monitoring_goal, query_type, target, ZONE)
+    connection.commit()
+
+
+def run_stage(function, traced):
+    """Runs function and returns its run time, or its peak memory (in bytes) if traced."""
+    if traced:
+        tracemalloc.start()
+        function()
+        peak = tracemalloc.get_traced_memory()[1]
+        tracemalloc.stop()
+        return peak
+
+    start = time.perf_counter()
+    function()
+    return time.perf_counter() - start
+
+
+def run_pipeline(run_dir, probes, start_ts, stop_ts, options, traced):
+    """Runs every stage once and returns {stage: (run time or peak memory, number of results)}."""
+    import analysis
+    import database
+
+    open_db(run_dir)
+    measurements = {}
+
+    # Results are generated before the stage, so that only storing them is measured
+    stored = 0
+    measured = 0
+    for msm_id, monitoring_goal, query_type, target, generator_options in MEASUREMENTS:
+        results = list(atlas_results.generate(monitoring_goal, msm_id, probes, start_ts, stop_ts,
+                                              get_interval(monitoring_goal, query_type), zone=ZONE,
+                                              **generator_options, **options))
+        measured += run_stage(lambda: database.store_measurements_in_db(
+            msm_id, monitoring_goal, query_type, target, ZONE, results), traced)
+        stored += len(results)
+        measurements[msm_id] = len(results)
+    stages = {'store': (measured, stored)}
+
+    for monitoring_goal, query_type in ANALYSES:
+        msm_ids = get_msm_ids(monitoring_goal, query_type)
+        results = sum(measurements[msm_id] for msm_id in msm_ids)
+        name = monitoring_goal if query_type is None else f'{monitoring_goal} {query_type}'
+
+        if monitoring_goal == 'trustchain':
+            query = lambda: database.get_return_code_counts(msm_ids, ZONE, start_ts, stop_ts)
+        else:
+            query = lambda: database.get_vp_counts(msm_ids, monitoring_goal, query_type, ZONE, start_ts, stop_ts)
+
+        def get_state(details, figure):
+            analysis.get_state(msm_ids, start_ts, stop_ts, monitoring_goal, query_type, details=details,
+                               figure=figure, output=os.devnull)
+
+        def update_rollup():
+            database.update_rollup(monitoring_goal, query_type, ZONE, msm_ids, stop_ts)
+
+        # Aggregating from the stored rows, then from the rollup of the closed bins (as '--status' does)
+        stages[f'query {name}'] = (run_stage(query, traced), results)
+        stages[f'update_rollup {name}'] = (run_stage(update_rollup, traced), results)
+        stages[f'query+rollup {name}'] = (run_stage(query, traced), results)
+        stages[f'get_state {name}'] = (run_stage(lambda: get_state(False, False), traced), results)
+        stages[f'get_state+json {name}'] = (run_stage(lambda: get_state(True, False), traced), results)
+        stages[f'get_state+plot {name}'] = (run_stage(lambda: get_state(False, True), traced), results)
+
+    return stages
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Benchmarks the pipeline of rollover_mon.py.')
+    parser.add_argument('--probes', type=int, nargs='+', default=[100, 1000, 10000], help='Numbers of probes')
+    parser.add_argument('--hours', type=float, default=2, help='Time span of the results')
+    parser.add_argument('--phase', choices=atlas_results.PHASES, default='publish', help='Phase of the rollover')
+    parser.add_argument('--rolled', choices=['zsk', 'ksk'], default='zsk', help='Type of the rolled key')
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as work_dir:
+        configure(work_dir)
+
+        # Bins are aligned to midnight, as they are in practice
+        start_ts = 1700006400
+        stop_ts = start_ts + int(args.hours * 3600)
+        options = {'phase': args.phase, 'rolled': args.rolled}
+
+        print(f'{"probes":>7} {"stage":<32} {"time (s)":>9} {"results/s":>11} {"peak (MB)":>10}')
+        for probes in args.probes:
+            timings = run_pipeline(os.path.join(work_dir, f'{probes}_timed'), probes, start_ts, stop_ts, options,
+                                   False)
+            peaks = run_pipeline(os.path.join(work_dir, f'{probes}_traced'), probes, start_ts, stop_ts, options, True)
+
+            for stage, (seconds, results) in timings.items():
+                print(f'{probes:>7} {stage:<32} {seconds:>9.3f} {results / seconds:>11.0f} '
+                      f'{peaks[stage][0] / 2 ** 20:>10.1f}')
+
+        os.chdir(REPO)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,55 @@
+"""Measures the start up time of rollover_mon.py per action.
+
+Every action only imports the modules it needs. For comparison, the time to import every module (as every action did
+before) is measured as well. Run from the root of the repository:
+
+    python benchmarks/startup.py [--runs N]
+"""
+import argparse
+import os
+import statistics
+import subprocess
+import sys
+
+REPO = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Modules that are imported by each action, on top of rollover_mon itself
+ACTIONS = {'start': [],
+           'stop': [],
+           'status': ['analysis'],
+           'groundtruth': ['analysis'],
+           'daemon': ['daemon'],
+           }
+EAGER = ['analysis', 'daemon', 'ripe.atlas.sagan']
+
+
+def measure_import(modules, runs):
+    """Returns the median time (in seconds) that a new interpreter needs to import rollover_mon and modules."""
+    code = ('import time\n'
+            't = time.perf_counter()\n'
+            f'import {", ".join(["rollover_mon"] + modules)}\n'
+            'print(time.perf_counter() - t)')
+
+    timings = []
+    for _ in range(runs):
+        output = subprocess.run([sys.executable, '-c', code], cwd=REPO, check=True, capture_output=True, text=True)
+        timings.append(float(output.stdout))
+
+    return statistics.median(timings)
+
+
+def main():
+    parser = argparse.ArgumentParser(description='Start up time of rollover_mon.py per action.')
+    parser.add_argument('--runs', type=int, default=5, help='Number of runs per action (the median is reported)')
+    args = parser.parse_args()
+
+    eager = measure_import(EAGER, args.runs)
+
+    print(f'{"action":<12} {"lazy (s)":>10} {"eager (s)":>10} {"saved":>8}')
+    for action, modules in ACTIONS.items():
+        lazy = measure_import(modules, args.runs)
+        print(f'{action:<12} {lazy:>10.3f} {eager:>10.3f} {1 - lazy / eager:>8.0%}')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,197 @@
+import logging
+import os
+import pandas as pd
+import database
+from misc.config import config
+from misc import profiling
+
+DAY = database.DAY
+
+# Columns of the aggregated rows of both kinds of rollups, as they are returned by the DB
+VP_COUNT_COLUMNS = ['bin', 'target', 'flags', 'key_tag', 'vps']
+TOTAL_COLUMNS = ['bin', 'target', 'flags', 'vps']
+RETURN_CODE_COLUMNS = ['bin', 'target', 'vp', 'return_code', 'query_type', 'responses']
+
+# Rows of a rollup in a day, including the totals (without key tag) of the VP counts
+QUERIES = {'vp_counts': 'SELECT bin, target, flags, key_tag, vps FROM rollup_vp_counts '
+                        'WHERE rollup = ? AND bin >= ? AND bin <= ?',
+           'return_codes': 'SELECT r.bin, r.target, v.vp, r.return_code, r.query_type, r.responses '
+                           'FROM rollup_return_codes r JOIN vps v ON v.vp_id = r.vp_id '
+                           'WHERE r.rollup = ? AND r.bin >= ? AND r.bin <= ?'}
+
+pyarrow_missing = False
+
+
+def get_cache_dir():
+    return config['DATABASE'].get('columnar_cache', fallback='') or None
+
+
+def is_enabled():
+    """Checks if the cache is configured and pyarrow is installed."""
+    global pyarrow_missing
+
+    if get_cache_dir() is None or pyarrow_missing:
+        return False
+
+    try:
+        import pyarrow
+    except ImportError:
+        logging.warning("'columnar_cache' is set, but pyarrow is not installed. The cache is not used")
+        pyarrow_missing = True
+        return False
+
+    return True
+
+
+def get_table(rollup):
+    return 'return_codes' if rollup.startswith('trustchain@') else 'vp_counts'
+
+
+def get_schema(table):
+    import pyarrow as pa
+
+    if table == 'vp_counts':
+        return pa.schema([('bin', pa.int64()), ('target', pa.string()), ('flags', pa.int32()),
+                          ('key_tag', pa.int32()), ('vps', pa.int32())])
+
+    return pa.schema([('bin', pa.int64()), ('target', pa.string()), ('vp', pa.string()),
+                      ('return_code', pa.int16()), ('query_type', pa.string()), ('responses', pa.int32())])
+
+
+def get_day_path(rollup, day):
+    return os.path.join(get_cache_dir(), rollup, f'{day}.parquet')
+
+
+@profiling.timed('cache.write')
+def write_day(cursor, rollup, day):
+    """Writes the aggregated rows of a rollup in a day to the Parquet file of the day."""
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    table = get_table(rollup)
+    schema = get_schema(table)
+
+    cursor.execute(QUERIES[table], (rollup, day, day + DAY - 1))
+    columns = list(zip(*cursor.fetchall())) or [[] for _ in schema]
+
+    path = get_day_path(rollup, day)
+    os.makedirs(os.path.dirname(path), exist_ok=True)
+
+    # Readers in other processes never see a partly written file
+    temp_path = f'{path}.{os.getpid()}.tmp'
+    pq.write_table(pa.table([pa.array(column, type=field.type) for column, field in zip(columns, schema)],
+                            schema=schema),
+                   temp_path)
+    os.replace(temp_path, path)
+    profiling.count('cache.days_written')
+
+
+def store_days(rollup, start_ts, end_ts):
+    """Writes the days of a rollup that have been closed completely between start_ts and end_ts, e.g. by an update of
+    the rollup."""
+    if not is_enabled():
+        return
+
+    with database.connect_db() as connection:
+        cursor = connection.cursor()
+        for day in range(start_ts - start_ts % DAY, end_ts - end_ts % DAY, DAY):
+            write_day(cursor, rollup, day)
+
+
+def drop_days(rollup, ts):
+    """Deletes the cached days of a rollup from the day of ts onwards, as their aggregates have been dropped."""
+    directory = os.path.join(get_cache_dir(), rollup)
+    if not os.path.isdir(directory):
+        return
+
+    for name in os.listdir(directory):
+        if name.endswith('.parquet') and int(name.split('.')[0]) + DAY > ts:
+            os.remove(os.path.join(directory, name))
+
+
+@profiling.timed('cache.read')
+def read_days(rollup, first_day, last_ts):
+    """Returns the aggregated rows of a rollup from first_day up to last_ts as a DataFrame.
+
+    Only the files of the requested days are opened, and they are memory mapped. Days that are not cached yet (e.g.
+    closed before the cache was configured) are written first.
+    """
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+
+    tables = []
+    with database.connect_db() as connection:
+        cursor = connection.cursor()
+
+        for day in range(first_day, last_ts + 1, DAY):
+            path = get_day_path(rollup, day)
+            if not os.path.exists(path):
+                write_day(cursor, rollup, day)
+
+            tables.append(pq.read_table(path, memory_map=True))
+
+    profiling.count('cache.days_read', len(tables))
+
+    return pa.concat_tables(tables).to_pandas()
+
+
+def split_time_frame(rollup, bin_width, start_date, end_date):
+    """Splits a time frame into the whole days that are read from the cache, and the parts before and after them.
+    Returns a list of (start, end, from_cache)."""
+    if not is_enabled() or DAY % bin_width != 0:
+        return [(start_date, end_date, False)]
+
+    with database.connect_db() as connection:
+        watermark = database.get_watermark(connection.cursor(), rollup, bin_width)
+
+    # Only days that have been aggregated completely are cached
+    if watermark is not None:
+        watermark -= watermark % DAY
+
+    return database.split_at_watermark(watermark, DAY, start_date, end_date)
+
+
+def concat(frames, columns):
+    frames = [frame for frame in frames if len(frame) > 0]
+    if len(frames) == 0:
+        return pd.DataFrame(columns=columns)
+
+    return pd.concat(frames, ignore_index=True)
+
+
+def get_vp_counts(msm_ids, monitoring_goal, query_type, zone, start_date, end_date):
+    """Returns the VP counts of database.get_vp_counts() as two DataFrames, with the whole days that have been
+    aggregated read from the cache."""
+    bin_width = database.get_bin_width(monitoring_goal, query_type, zone)
+    rollup = database.get_rollup_name(monitoring_goal, query_type, zone)
+    key_counts = []
+    total_counts = []
+
+    for first_ts, last_ts, from_cache in split_time_frame(rollup, bin_width, start_date, end_date):
+        if from_cache:
+            counts = read_days(rollup, first_ts, last_ts)
+            key_counts.append(counts[counts['key_tag'].notna()])
+            total_counts.append(counts[counts['key_tag'].isna()].drop(columns='key_tag'))
+        else:
+            keys, totals = database.get_vp_counts(msm_ids, monitoring_goal, query_type, zone, first_ts, last_ts)
+            key_counts.append(pd.DataFrame(keys, columns=VP_COUNT_COLUMNS))
+            total_counts.append(pd.DataFrame(totals, columns=TOTAL_COLUMNS))
+
+    return concat(key_counts, VP_COUNT_COLUMNS), concat(total_counts, TOTAL_COLUMNS)
+
+
+def get_return_code_counts(msm_ids, zone, start_date, end_date):
+    """Returns the response counts of database.get_return_code_counts() as a DataFrame, with the whole days that have
+    been aggregated read from the cache."""
+    bin_width = database.get_bin_width('trustchain', None, zone)
+    rollup = database.get_rollup_name('trustchain', None, zone)
+    counts = []
+
+    for first_ts, last_ts, from_cache in split_time_frame(rollup, bin_width, start_date, end_date):
+        if from_cache:
+            counts.append(read_days(rollup, first_ts, last_ts))
+        else:
+            counts.append(pd.DataFrame(database.get_return_code_counts(msm_ids, zone, first_ts, last_ts),
+                                       columns=RETURN_CODE_COLUMNS))
+
+    return concat(counts, RETURN_CODE_COLUMNS)
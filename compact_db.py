@@ -0,0 +1,18 @@
+from misc.config import config
+import database
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def compact_db():
+    retention_days = config['DATABASE'].getint('retention_days', fallback=0)
+    if retention_days <= 0:
+        logging.info("Set 'retention_days' in the config to compact the DB")
+        return
+
+    database.compact_measurement_data(retention_days)
+
+
+if __name__ == '__main__':
+    compact_db()
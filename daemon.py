@@ -0,0 +1,366 @@
+import datetime as dt
+import heapq
+import logging
+import select
+import signal
+import sqlite3
+import threading
+import time
+from urllib.parse import urlparse
+import requests
+import websocket
+from ripe.atlas.cousteau import AtlasStream
+import database
+import ripe_interface
+from misc.config import config
+from misc import profiling
+
+stop_event = threading.Event()
+
+# Errors of a broken connection to the result stream, e.g. a closed socket or a failed handshake
+STREAM_ERRORS = (OSError, ValueError, websocket.WebSocketException)
+
+
+def handle_signal(signum, frame):
+    if stop_event.is_set():
+        # E.g. while waiting for the stream to come back
+        raise SystemExit(f'Received signal {signum} again, stopping immediately')
+
+    logging.info(f'Received signal {signum}, stopping the daemon')
+    stop_event.set()
+
+
+def get_rollup_key(msm_attributes):
+    """Returns (monitoring goal, query type, zone) of the rollup that aggregates a measurement."""
+    monitoring_goal, query_type, _, _, zone = msm_attributes
+    if monitoring_goal == 'trustchain':
+        return monitoring_goal, None, zone
+
+    return monitoring_goal, query_type, zone
+
+
+def update_rollups(rollup_keys, msm_attributes, fetched_until):
+    """Aggregates the closed bins of the given rollups.
+
+    A rollup can only be updated up to the time up to which the results of every running measurement it aggregates
+    have been fetched.
+    """
+    for monitoring_goal, query_type, zone in rollup_keys:
+        msm_ids, _ = database.get_measurements(monitoring_goal, query_type, None, zone)
+        running = [msm_id for msm_id in msm_ids if msm_id in msm_attributes]
+
+        if len(running) > 0 and all(msm_id in fetched_until for msm_id in running):
+            try:
+                database.update_rollup(monitoring_goal, query_type, zone, msm_ids,
+                                       min(fetched_until[msm_id] for msm_id in running))
+            except database.CompactedRollupError as e:
+                logging.error(e)
+
+
+def poll(due, msm_attributes, fetched_until):
+    """Fetches and stores the new results of the due measurements."""
+    stop_date = dt.datetime.now(dt.UTC)
+    logging.info(f'Polling measurements {", ".join(str(msm_id) for msm_id in due)}')
+
+    try:
+        failed = ripe_interface.store_new_results(due, msm_attributes, stop_date)
+    except Exception as e:
+        # The measurements are polled again at their next turn
+        logging.error(f'Polling measurements failed: {e}')
+        return
+
+    # Measurements whose download failed keep their previous time, so that their rollups are not closed beyond it
+    for msm_id in due:
+        if msm_id not in failed:
+            fetched_until[msm_id] = stop_date.timestamp()
+
+    update_rollups({get_rollup_key(msm_attributes[msm_id]) for msm_id in due}, msm_attributes, fetched_until)
+
+
+def compact(next_compaction):
+    """Compacts the DB if it is due and 'retention_days' is set. Returns when the next compaction is due."""
+    now = time.time()
+    retention_days = config['DATABASE'].getint('retention_days', fallback=0)
+    if retention_days <= 0 or now < next_compaction:
+        return next_compaction
+
+    try:
+        database.compact_measurement_data(retention_days)
+    except (sqlite3.Error, database.CompactedRollupError) as e:
+        logging.error(f'Compacting the DB failed: {e}')
+
+    return now + config.getint('DAEMON', 'compact_interval', fallback=86400)
+
+
+def run_daemon(stream=False):
+    """Keeps the DB up to date with the results of every running measurement.
+
+    With stream, results are received from the RIPE Atlas result stream as soon as they are reported. Otherwise, the
+    measurements are polled.
+    """
+    signal.signal(signal.SIGINT, handle_signal)
+    signal.signal(signal.SIGTERM, handle_signal)
+
+    logging.info('Daemon started')
+
+    if stream:
+        run_stream()
+    else:
+        run_polling()
+
+    logging.info('Daemon stopped')
+
+
+def run_polling():
+    """Polls the results of every running measurement.
+
+    Every measurement is polled once per measurement interval. The list of running measurements is read from the DB
+    every 'refresh_interval' seconds, so that measurements that are started or stopped are picked up.
+    """
+    refresh_interval = config.getint('DAEMON', 'refresh_interval', fallback=300)
+    min_poll_interval = config.getint('DAEMON', 'min_poll_interval', fallback=60)
+
+    # (time of the next poll, msm_id)
+    schedule = []
+    msm_attributes = {}
+    fetched_until = {}
+    next_refresh = 0
+    next_compaction = 0
+
+    while not stop_event.is_set():
+        now = time.time()
+
+        if now >= next_refresh:
+            next_compaction = compact(next_compaction)
+
+            msm_ids, msm_attributes = database.get_running_measurements()
+            scheduled = {msm_id for _, msm_id in schedule}
+
+            # New measurements are polled right away, stopped ones are dropped from the schedule
+            for msm_id in msm_ids:
+                if msm_id not in scheduled:
+                    heapq.heappush(schedule, (now, msm_id))
+            schedule = [(ts, msm_id) for ts, msm_id in schedule if msm_id in msm_attributes]
+            heapq.heapify(schedule)
+            fetched_until = {msm_id: ts for msm_id, ts in fetched_until.items() if msm_id in msm_attributes}
+
+            logging.info(f'{len(schedule)} running measurements scheduled')
+            next_refresh = now + refresh_interval
+
+        due = []
+        while len(schedule) > 0 and schedule[0][0] <= now:
+            due.append(heapq.heappop(schedule)[1])
+
+        if len(due) > 0:
+            poll(due, msm_attributes, fetched_until)
+
+            for msm_id in due:
+                monitoring_goal, query_type, _, _, zone = msm_attributes[msm_id]
+                interval = ripe_interface.get_measurement_interval(monitoring_goal, query_type, zone)
+                heapq.heappush(schedule, (now + max(interval, min_poll_interval), msm_id))
+
+        next_poll = schedule[0][0] if len(schedule) > 0 else next_refresh
+        stop_event.wait(max(min(next_poll, next_refresh) - time.time(), 0))
+
+
+def backfill(msm_ids, msm_attributes, fetched_until):
+    """Fetches the results that were reported while the measurements were not streamed, e.g. during a disconnect."""
+    stop_date = dt.datetime.now(dt.UTC)
+
+    try:
+        failed = ripe_interface.store_new_results(msm_ids, msm_attributes, stop_date)
+    except Exception as e:
+        logging.error(f'Backfilling measurements failed: {e}')
+        failed = set(msm_ids)
+
+    # Measurements that are not in fetched_until are backfilled again at the next refresh
+    for msm_id in msm_ids:
+        if msm_id in failed:
+            fetched_until.pop(msm_id, None)
+        else:
+            fetched_until[msm_id] = stop_date.timestamp()
+
+
+def store_streamed_results(buffered, msm_attributes):
+    """Stores the buffered results of the stream and empties the buffer."""
+    for msm_id, results in buffered.items():
+        monitoring_goal, query_type, target, _, zone = msm_attributes[msm_id]
+        database.store_measurements_in_db(msm_id, monitoring_goal, query_type, target, zone, results)
+        profiling.count('stream.results', len(results))
+
+    buffered.clear()
+
+
+def close_stream(stream):
+    if stream.ws is not None:
+        try:
+            stream.ws.close()
+        except STREAM_ERRORS:
+            pass
+        stream.ws = None
+
+
+def get_proxy_options(url):
+    """Returns the websocket-client options of the proxy that the environment (e.g. https_proxy and no_proxy) sets for
+    the websocket URL."""
+    http_url = urlparse(url)._replace(scheme='https' if url.startswith('wss:') else 'http')
+    proxies = requests.utils.get_environ_proxies(http_url.geturl())
+    proxy_url = proxies.get(http_url.scheme) or proxies.get('all')
+    if not proxy_url:
+        return {}
+
+    proxy = urlparse(proxy_url)
+    options = {'proxy_type': proxy.scheme, 'http_proxy_host': proxy.hostname, 'http_proxy_port': proxy.port}
+    if proxy.username is not None:
+        options['http_proxy_auth'] = (proxy.username, proxy.password)
+
+    return options
+
+
+def connect_stream(stream):
+    """(Re)connects to the result stream and subscribes to every measurement of stream.subscriptions.
+
+    Failed attempts are retried with exponential backoff, up to 'stream_max_backoff' seconds between two attempts.
+    Returns False if the daemon is stopped before the stream is connected.
+    """
+    max_backoff = config.getint('DAEMON', 'stream_max_backoff', fallback=300)
+    backoff = 1
+
+    while not stop_event.is_set():
+        close_stream(stream)
+        try:
+            stream.ws = websocket.create_connection(stream.url, header=stream.headers, timeout=30,
+                                                    **get_proxy_options(stream.url))
+            stream.ws.settimeout(None)
+            for subscription in stream.subscriptions:
+                stream.send(stream.ws, AtlasStream.EVENT_NAME_SUBSCRIBE, subscription)
+
+            logging.info('Connected to the RIPE Atlas stream')
+            return True
+
+        except STREAM_ERRORS as e:
+            logging.error(f'Connecting to the RIPE Atlas stream failed: {e}. Retrying in {backoff} s')
+            stop_event.wait(backoff)
+            backoff = min(backoff * 2, max_backoff)
+
+    close_stream(stream)
+    return False
+
+
+def update_subscriptions(stream, new_msm_ids, stopped_msm_ids):
+    """Subscribes to the new and unsubscribes from the stopped measurements.
+
+    The subscriptions are kept in stream.subscriptions, from which they are sent again after a reconnect. Returns False
+    if the stream disconnected while sending them.
+    """
+    for msm_id in stopped_msm_ids:
+        subscription = {'msm': msm_id, 'stream_type': AtlasStream.STREAM_TYPE_RESULT}
+        if subscription in stream.subscriptions:
+            stream.subscriptions.remove(subscription)
+    stream.subscriptions.extend({'msm': msm_id, 'stream_type': AtlasStream.STREAM_TYPE_RESULT}
+                                for msm_id in new_msm_ids)
+
+    if stream.ws is None:
+        return False
+
+    try:
+        for msm_id in stopped_msm_ids:
+            stream.send(stream.ws, AtlasStream.EVENT_NAME_UNSUBSCRIBE,
+                        {'msm': msm_id, 'stream_type': AtlasStream.STREAM_TYPE_RESULT})
+        for msm_id in new_msm_ids:
+            stream.send(stream.ws, AtlasStream.EVENT_NAME_SUBSCRIBE,
+                        {'msm': msm_id, 'stream_type': AtlasStream.STREAM_TYPE_RESULT})
+    except STREAM_ERRORS as e:
+        logging.error(f'RIPE Atlas stream disconnected: {e}')
+        return False
+
+    return True
+
+
+def run_stream():
+    """Receives the results of every running measurement from the RIPE Atlas result stream.
+
+    Results are buffered and stored every 'stream_flush_interval' seconds. After (re)connecting, the results that were
+    missed are backfilled from the results API. The stream URL can be changed with 'stream_url', e.g. to use a local
+    stand-in of the stream for tests.
+    """
+    refresh_interval = config.getint('DAEMON', 'refresh_interval', fallback=300)
+    flush_interval = config.getint('DAEMON', 'stream_flush_interval', fallback=5)
+    batch_size = config['RIPE'].getint('results_batch_size', fallback=1000)
+
+    stream = AtlasStream(base_url=config.get('RIPE', 'stream_url', fallback='https://atlas-stream.ripe.net'))
+
+    msm_attributes = {}
+    fetched_until = {}
+    buffered = {}
+    pending = 0
+    next_refresh = 0
+    next_compaction = 0
+    next_flush = time.time() + flush_interval
+
+    while not stop_event.is_set():
+        now = time.time()
+
+        if now >= next_refresh:
+            store_streamed_results(buffered, msm_attributes)
+            pending = 0
+
+            msm_ids, running = database.get_running_measurements()
+            new_msm_ids = [msm_id for msm_id in msm_ids if msm_id not in msm_attributes]
+            stopped_msm_ids = [msm_id for msm_id in msm_attributes if msm_id not in running]
+            # New measurements and measurements of which the backfill failed
+            missed_msm_ids = [msm_id for msm_id in msm_ids if msm_id not in fetched_until]
+
+            for msm_id in stopped_msm_ids:
+                fetched_until.pop(msm_id, None)
+            msm_attributes = running
+
+            if not update_subscriptions(stream, new_msm_ids, stopped_msm_ids):
+                if stream.ws is not None:
+                    # Results may have been missed since the last flush
+                    missed_msm_ids = msm_ids
+                if not connect_stream(stream):
+                    break
+            backfill(missed_msm_ids, msm_attributes, fetched_until)
+
+            update_rollups({get_rollup_key(attributes) for attributes in msm_attributes.values()}, msm_attributes,
+                           fetched_until)
+
+            next_compaction = compact(next_compaction)
+
+            logging.info(f'Streaming results of {len(msm_attributes)} running measurements')
+            next_refresh = now + refresh_interval
+
+        try:
+            readable, _, _ = select.select([stream.ws], [], [], max(min(next_flush, next_refresh) - now, 0))
+            if len(readable) > 0:
+                event_name, payload = stream.recv(stream.ws)
+
+                if event_name == AtlasStream.EVENT_NAME_RESULTS and payload.get('msm_id') in msm_attributes:
+                    buffered.setdefault(payload['msm_id'], []).append(payload)
+                    pending += 1
+                elif event_name == AtlasStream.EVENT_NAME_ERROR:
+                    logging.warning(f'Error from RIPE Atlas stream: {payload}')
+
+        except STREAM_ERRORS as e:
+            logging.error(f'RIPE Atlas stream disconnected: {e}')
+            store_streamed_results(buffered, msm_attributes)
+            pending = 0
+
+            if not connect_stream(stream):
+                break
+            backfill(list(msm_attributes), msm_attributes, fetched_until)
+
+        if pending >= batch_size or time.time() >= next_flush:
+            received_until = time.time()
+            store_streamed_results(buffered, msm_attributes)
+            pending = 0
+            next_flush = time.time() + flush_interval
+
+            # Every result reported until now has been received, results that arrive late are covered by the grace
+            # period of the rollups
+            for msm_id in fetched_until:
+                fetched_until[msm_id] = received_until
+
+    store_streamed_results(buffered, msm_attributes)
+    close_stream(stream)
@@ -1,10 +1,17 @@
+import itertools
+import math
+import multiprocessing
 import sqlite3
+import struct
+import threading
 import time
-from ripe.atlas.sagan import DnsResult
-from misc.tools import calc_keyid
-from misc.config import config
+from collections import deque
+from concurrent.futures import ProcessPoolExecutor
+from misc.tools import calc_keyid, calc_keyid_wire, return_code_to_int
+from misc.dns_wire import MalformedAbuf, TYPE_DNSKEY, get_return_code, parse_abuf
+from misc.config import config, get_zone_section
+from misc import profiling
 import logging
-import json
 
 log_level_info = {'DEBUG': logging.DEBUG,
                   'INFO': logging.INFO,
@@ -13,140 +20,804 @@ log_level_info = {'DEBUG': logging.DEBUG,
                   }
 
 
+connections = threading.local()
+parse_pool = None
+
+DNSKEY_HEADER = struct.Struct('!HBB')
+DS_KEY_TAG = struct.Struct('!H')
+
+DAY = 24 * 60 * 60
+
+SYNCHRONOUS_MODES = ['OFF', 'NORMAL', 'FULL', 'EXTRA']
+
+
+class CompactedRollupError(ValueError):
+    """Raised if the compacted bins of a rollup, whose rows have been deleted, do not fit the config anymore."""
+
+
 def connect_db():
-    return sqlite3.connect(config['DATABASE']['db_path'])
+    """Returns the DB connection of the current thread.
+
+    The connection is opened on first use and reused afterwards. It runs in WAL mode, so that the DB can be read
+    while measurement results are written.
+    """
+    connection = getattr(connections, 'connection', None)
+
+    if connection is None:
+        synchronous = get_synchronous_mode()
+        connection = sqlite3.connect(config['DATABASE']['db_path'],
+                                     cached_statements=config['DATABASE'].getint('cached_statements', fallback=256))
+
+        connection.execute('PRAGMA journal_mode = WAL')
+        # In WAL mode, NORMAL is safe against corruption and only syncs at checkpoints
+        connection.execute(f'PRAGMA synchronous = {synchronous}')
+        connection.execute(f"PRAGMA cache_size = -{config['DATABASE'].getint('cache_size_mb', fallback=64) * 1024}")
+        connection.execute(f"PRAGMA mmap_size = {config['DATABASE'].getint('mmap_size_mb', fallback=256) * 2 ** 20}")
+
+        connections.connection = connection
+
+    return connection
+
 
+def get_synchronous_mode():
+    """Returns the configured 'synchronous' mode, which is put into a PRAGMA and therefore checked first."""
+    mode = config['DATABASE'].get('synchronous', fallback='NORMAL').upper()
+    if mode not in SYNCHRONOUS_MODES:
+        raise ValueError(f"'synchronous' must be one of {', '.join(SYNCHRONOUS_MODES)}, not '{mode}'")
 
-def init_measurement(msm_id, monitoring_goal, query_type, target):
+    return mode
+
+
+def init_measurement(msm_id, monitoring_goal, query_type, target, zone):
     """Inserts new measurements to DB."""
 
     connection = connect_db()
     cursor = connection.cursor()
 
-    cursor.execute('INSERT INTO measurements VALUES (?, ?, ?, ?, ?, ?)',
-                   (msm_id, monitoring_goal, query_type, target, int(time.time()), True))
+    cursor.execute('INSERT INTO measurements (msm_id, monitoring_goal, query_type, target, ts, running, zone) '
+                   'VALUES (?, ?, ?, ?, ?, ?, ?)',
+                   (msm_id, monitoring_goal, query_type, target, int(time.time()), True, zone))
 
     connection.commit()
 
-    connection.close()
-
 
-def get_measurements(monitoring_goal, query_type, running):
-    """Gets the measurements from the DB (only running or all)."""
+def get_measurements(monitoring_goal, query_type, running, zone):
+    """Gets the measurements of a zone from the DB (only running or all)."""
 
     connection = connect_db()
     cursor = connection.cursor()
 
+    query = ('SELECT msm_id, monitoring_goal, query_type, target, ts, zone FROM measurements '
+             'WHERE zone = ? and monitoring_goal = ?')
+    params = [zone, monitoring_goal]
+
     if monitoring_goal != 'trustchain':
-        if running:
-            cursor.execute(
-                'SELECT msm_id, monitoring_goal, query_type, target, ts FROM measurements WHERE running  = 1 and monitoring_goal = ? and query_type = ?',
-                (monitoring_goal, query_type))
-        else:
-            cursor.execute(
-                'SELECT msm_id, monitoring_goal, query_type, target, ts FROM measurements WHERE monitoring_goal = ? and query_type = ?',
-                (monitoring_goal, query_type))
-    else:
-        if running:
-            cursor.execute(
-                'SELECT msm_id, monitoring_goal, query_type, target, ts  FROM measurements WHERE running = 1 and monitoring_goal = ?',
-                (monitoring_goal,))
-        else:
-            cursor.execute(
-                'SELECT msm_id, monitoring_goal, query_type, target, ts FROM measurements WHERE monitoring_goal = ?',
-                (monitoring_goal,))
+        query += ' and query_type = ?'
+        params.append(query_type)
+    if running:
+        query += ' and running = 1'
+
+    cursor.execute(query, params)
 
     msm_ids = []
     msm_attributes = {}
     rows = cursor.fetchall()
     for row in rows:
         msm_ids.append(row[0])
-        msm_attributes[row[0]] = [row[1], row[2], row[3], row[4]]
+        msm_attributes[row[0]] = [row[1], row[2], row[3], row[4], row[5]]
+
+    return msm_ids, msm_attributes
+
+
+def get_running_measurements():
+    """Gets the running measurements of every monitoring goal from the DB."""
+
+    connection = connect_db()
+    cursor = connection.cursor()
+
+    cursor.execute('SELECT msm_id, monitoring_goal, query_type, target, ts, zone FROM measurements WHERE running = 1')
+
+    msm_ids = []
+    msm_attributes = {}
+    for row in cursor.fetchall():
+        msm_ids.append(row[0])
+        msm_attributes[row[0]] = [row[1], row[2], row[3], row[4], row[5]]
 
-    connection.close()
     return msm_ids, msm_attributes
 
 
-def get_stored_measurements(msm_id, monitoring_goal, query_type, target, start_date, end_date):
+def get_all_measurements():
+    """Gets every measurement from the DB, running or not, of every monitoring goal."""
+
+    connection = connect_db()
+    cursor = connection.cursor()
+
+    cursor.execute('SELECT msm_id, monitoring_goal, query_type, target, ts, zone FROM measurements')
+
+    msm_ids = []
+    msm_attributes = {}
+    for row in cursor.fetchall():
+        msm_ids.append(row[0])
+        msm_attributes[row[0]] = [row[1], row[2], row[3], row[4], row[5]]
+
+    return msm_ids, msm_attributes
+
+
+def select_binned_rows(msm_ids):
+    """Returns the SQL that selects the stored rows of the given measurements in a time frame, together with the time
+    bin of every row. Rows of excluded VPs are left out.
+
+    Bins start at midnight (UTC) of the first day with data, like the bins of pd.Grouper. The statement expects the
+    msm IDs, start and end of the time frame and the bin width (twice) as parameters.
+    """
+    return ('WITH selected AS ('
+            'SELECT d.ts, d.vp_id, m.target, m.query_type, d.key_tag, d.flags, d.return_code '
+            'FROM measurement_data d JOIN measurements m ON m.msm_id = d.msm_id '
+            f'WHERE d.msm_id IN ({", ".join("?" * len(msm_ids))}) AND d.ts >= ? AND d.ts <= ? '
+            'AND d.vp_id NOT IN (SELECT v.vp_id FROM excluded_vps e JOIN vps v ON v.vp = e.vp)'
+            '), origin AS ('
+            'SELECT min(ts) - min(ts) % 86400 AS ts FROM selected'
+            ') '
+            'SELECT origin.ts + (selected.ts - origin.ts) / ? * ? AS bin, selected.* FROM selected, origin')
+
+
+def get_bin_width(monitoring_goal, query_type, zone):
+    """Returns the width (in seconds) of the time bins in which the results of a monitoring goal are analyzed."""
+    if monitoring_goal == 'pubdelay':
+        return int(get_zone_section('MEASUREMENTS', zone)['msm_frequency_publication_delay'])
+    elif monitoring_goal == 'propdelay':
+        return int(get_zone_section('TTLS', zone)[f'ttl_{query_type}'])
+
+    return int(get_zone_section('TTLS', zone)['ttl_dnskey']) * 2
+
+
+def get_rollup_name(monitoring_goal, query_type, zone):
+    """Returns the name of the rollup of a monitoring goal of a zone, e.g. 'pubdelay_dnskey@example.nl.'."""
+    if monitoring_goal == 'trustchain':
+        return f'{monitoring_goal}@{zone}'
+
+    return f'{monitoring_goal}_{query_type}@{zone}'
+
+
+def clear_rollups(cursor, rollup=None):
+    """Drops the aggregates of a rollup, or of every rollup if no rollup is given.
+
+    Aggregates of compacted bins are kept, as their rows have been deleted and cannot be aggregated again.
+    """
+    rollups = 'rollup' if rollup is None else '?'
+    params = () if rollup is None else (rollup,)
+
+    cursor.execute(f'SELECT w.rollup, coalesce(c.ts, 0) FROM rollup_watermarks w '
+                   f'LEFT JOIN rollup_compactions c ON c.rollup = w.rollup '
+                   f'WHERE w.rollup = {"w.rollup" if rollup is None else "?"}',
+                   params)
+    for name, compacted_until in cursor.fetchall():
+        drop_cached_days(name, compacted_until)
+
+    for table in ['rollup_vp_counts', 'rollup_return_codes']:
+        cursor.execute(f'DELETE FROM {table} WHERE rollup = {rollups} AND bin >= coalesce('
+                       f'(SELECT c.ts FROM rollup_compactions c WHERE c.rollup = {table}.rollup), 0)',
+                       params)
+
+    cursor.execute(f'DELETE FROM rollup_watermarks WHERE rollup = {rollups} '
+                   f'AND rollup NOT IN (SELECT rollup FROM rollup_compactions)',
+                   params)
+    cursor.execute(f'UPDATE rollup_watermarks '
+                   f'SET ts = (SELECT c.ts FROM rollup_compactions c WHERE c.rollup = rollup_watermarks.rollup) '
+                   f'WHERE rollup = {rollups} AND rollup IN (SELECT rollup FROM rollup_compactions)',
+                   params)
+
+
+def drop_cached_days(rollup, ts):
+    """Deletes the days of a rollup from the day of ts onwards from the columnar cache, if it is configured."""
+    if config['DATABASE'].get('columnar_cache', fallback=''):
+        import columnar_cache
+        columnar_cache.drop_days(rollup, ts)
+
+
+def format_ts(ts):
+    return time.strftime('%Y-%m-%d %H:%M', time.gmtime(ts))
+
+
+def get_compacted_until(cursor, rollup):
+    """Returns the end of the compacted bins of a rollup, whose rows have been deleted, or None."""
+    cursor.execute('SELECT ts FROM rollup_compactions WHERE rollup = ?', (rollup,))
+    row = cursor.fetchone()
+
+    return None if row is None else row[0]
+
+
+def get_watermark(cursor, rollup, bin_width):
+    """Returns the end of the aggregated bins of a rollup, or None if no bins of this width have been aggregated."""
+    if DAY % bin_width != 0:
+        return None
+
+    cursor.execute('SELECT bin_width, ts FROM rollup_watermarks WHERE rollup = ?', (rollup,))
+    row = cursor.fetchone()
+
+    if row is None:
+        return None
+    elif row[0] != bin_width:
+        # The bin width has been changed in the config since the bins have been aggregated. Compacted bins cannot be
+        # aggregated with the new width, and an analysis would mix both widths.
+        compacted_until = get_compacted_until(cursor, rollup)
+        if compacted_until is not None:
+            raise CompactedRollupError(f'The bin width of {rollup} has been changed from {row[0]} to {bin_width} '
+                                       f'seconds, but its bins before {format_ts(compacted_until)} have been '
+                                       f'compacted with the old width. Set the TTL or frequency it is derived from '
+                                       f'back')
+
+        clear_rollups(cursor, rollup)
+        return None
+
+    return row[1]
+
+
+def rewind_rollup(cursor, rollup, ts):
+    """Drops the aggregated bins of a rollup from the bin of ts onwards, so that they are aggregated again."""
+    cursor.execute('SELECT bin_width, ts FROM rollup_watermarks WHERE rollup = ?', (rollup,))
+    row = cursor.fetchone()
+
+    if row is not None and ts < row[1]:
+        # Compacted bins cannot be aggregated again, store_measurements_in_db() drops their rows
+        first_bin = max(ts - ts % row[0], get_compacted_until(cursor, rollup) or 0)
+        if first_bin >= row[1]:
+            return
+
+        logging.info(f'Results before the rollup watermark of {rollup} stored, aggregating again from {first_bin}')
+        drop_cached_days(rollup, first_bin)
+
+        cursor.execute('DELETE FROM rollup_vp_counts WHERE rollup = ? AND bin >= ?', (rollup, first_bin))
+        cursor.execute('DELETE FROM rollup_return_codes WHERE rollup = ? AND bin >= ?', (rollup, first_bin))
+        cursor.execute('UPDATE rollup_watermarks SET ts = ? WHERE rollup = ?', (first_bin, rollup))
+
+
+@profiling.timed('db.rollup')
+def update_rollup(monitoring_goal, query_type, zone, msm_ids, complete_until):
+    """Aggregates the time bins that have been closed since the last update into the rollup of a monitoring goal.
+
+    complete_until is the timestamp up to which the results of all measurements (msm_ids) have been stored. As results
+    can arrive late at RIPE Atlas, a bin is only closed once it ended 'rollup_grace' seconds before that. Bins that are
+    not aligned to midnight depend on the analyzed time frame and are never aggregated.
+    """
+    bin_width = get_bin_width(monitoring_goal, query_type, zone)
+    if DAY % bin_width != 0 or len(msm_ids) == 0:
+        return
+
+    rollup = get_rollup_name(monitoring_goal, query_type, zone)
+    grace = config['DATABASE'].getint('rollup_grace', fallback=900)
+
     with connect_db() as connection:
         cursor = connection.cursor()
 
-        cursor.execute('SELECT msm_id, monitoring_goal, query_type, target, ts, vp, vals FROM measurement_data '
-                       'WHERE msm_id = ? and monitoring_goal = ? and query_type = ? and target = ? and ts >= ? and ts <= ?'
-                       'AND vp not in ('
-                       'SELECT vp FROM excluded_vps'
-                       ')'
-                       'ORDER BY ts',
-                       (msm_id, monitoring_goal, query_type, target, start_date, end_date))
+        # The daemon and a status run can update the same rollup at once. Taking the write lock before reading the
+        # watermark lets only one of them aggregate the bins after it.
+        cursor.execute('BEGIN IMMEDIATE')
+
+        watermark = get_watermark(cursor, rollup, bin_width)
+        if watermark is None:
+            cursor.execute(f'SELECT min(ts) FROM measurement_data WHERE msm_id IN ({", ".join("?" * len(msm_ids))})',
+                           msm_ids)
+            first_ts = cursor.fetchone()[0]
+            if first_ts is None:
+                return
+
+            watermark = first_ts - first_ts % bin_width
+
+        new_watermark = int(min(complete_until, time.time()) - grace) // bin_width * bin_width
+        if new_watermark <= watermark:
+            return
+
+        params = (rollup, *msm_ids, watermark, new_watermark - 1, bin_width, bin_width)
+
+        if monitoring_goal == 'trustchain':
+            cursor.execute(f'INSERT INTO rollup_return_codes '
+                           f'(rollup, bin, target, vp_id, return_code, query_type, responses) '
+                           f'SELECT ?, bin, target, vp_id, return_code, query_type, COUNT(*) '
+                           f'FROM ({select_binned_rows(msm_ids)}) '
+                           f'GROUP BY bin, target, vp_id, return_code, query_type',
+                           params)
+        else:
+            cursor.execute(f'INSERT INTO rollup_vp_counts (rollup, bin, target, flags, key_tag, vps) '
+                           f'SELECT ?, bin, target, flags, key_tag, COUNT(DISTINCT vp_id) '
+                           f'FROM ({select_binned_rows(msm_ids)}) '
+                           f'GROUP BY bin, target, flags, key_tag',
+                           params)
+            cursor.execute(f'INSERT INTO rollup_vp_counts (rollup, bin, target, flags, key_tag, vps) '
+                           f'SELECT ?, bin, target, flags, NULL, COUNT(DISTINCT vp_id) '
+                           f'FROM ({select_binned_rows(msm_ids)}) '
+                           f'GROUP BY bin, target, flags',
+                           params)
+
+        cursor.execute('INSERT OR REPLACE INTO rollup_watermarks (rollup, bin_width, ts) VALUES (?, ?, ?)',
+                       (rollup, bin_width, new_watermark))
+        connection.commit()
+
+    logging.info(f'Rollup {rollup} aggregated up to {new_watermark}')
+
+    if config['DATABASE'].get('columnar_cache', fallback=''):
+        import columnar_cache
+        columnar_cache.store_days(rollup, watermark, new_watermark)
 
-        return cursor.fetchall()
 
+def get_rollup_keys():
+    """Returns (monitoring goal, query type, zone) of the rollup of every stored measurement."""
+    with connect_db() as connection:
+        cursor = connection.cursor()
+        cursor.execute('SELECT DISTINCT monitoring_goal, query_type, zone FROM measurements')
+
+        return sorted({(monitoring_goal, None if monitoring_goal == 'trustchain' else query_type, zone)
+                       for monitoring_goal, query_type, zone in cursor.fetchall()}, key=str)
+
+
+def compact_measurement_data(retention_days):
+    """Folds the rows that are older than retention_days into the rollups and deletes them.
+
+    The bins of those rows are aggregated first, then the rows are deleted one day at a time, so that writers are not
+    blocked for long. The analyzers read the compacted bins from the rollups like any other closed bin. Freed pages
+    are given back to the file system if the DB uses incremental auto vacuum.
+    """
+    cutoff = (int(time.time()) - retention_days * DAY) // DAY * DAY
+    grace = config['DATABASE'].getint('rollup_grace', fallback=900)
+
+    for monitoring_goal, query_type, zone in get_rollup_keys():
+        rollup = get_rollup_name(monitoring_goal, query_type, zone)
+        bin_width = get_bin_width(monitoring_goal, query_type, zone)
+        if DAY % bin_width != 0:
+            logging.warning(f'Rows of {rollup} are not compacted, as its bin width does not divide a day')
+            continue
+
+        msm_ids, _ = get_measurements(monitoring_goal, query_type, None, zone)
+        placeholders = ', '.join('?' * len(msm_ids))
+
+        # Every result before the cutoff is final, so the bins up to there can be closed
+        update_rollup(monitoring_goal, query_type, zone, msm_ids, cutoff + grace)
+
+        with connect_db() as connection:
+            cursor = connection.cursor()
+
+            watermark = get_watermark(cursor, rollup, bin_width)
+            cursor.execute(f'SELECT min(ts) FROM measurement_data WHERE msm_id IN ({placeholders})', msm_ids)
+            first_ts = cursor.fetchone()[0]
+            if watermark is None or first_ts is None:
+                continue
+
+            compact_until = min(cutoff, watermark)
+            deleted = 0
+            for day in range(first_ts - first_ts % DAY, compact_until, DAY):
+                # Late results stored meanwhile rewind the rollup, their bins must not be deleted before they are
+                # aggregated again
+                watermark = get_watermark(cursor, rollup, bin_width)
+                if watermark is None or day >= min(compact_until, watermark):
+                    break
+                compact_until = min(compact_until, watermark)
+
+                cursor.execute(f'DELETE FROM measurement_data WHERE msm_id IN ({placeholders}) AND ts < ?',
+                               (*msm_ids, min(day + DAY, compact_until)))
+                deleted += cursor.rowcount
+
+                cursor.execute('INSERT OR REPLACE INTO rollup_compactions (rollup, ts) VALUES (?, ?)',
+                               (rollup, max(min(day + DAY, compact_until), get_compacted_until(cursor, rollup) or 0)))
+                connection.commit()
+                cursor.execute('PRAGMA incremental_vacuum').fetchall()
+
+        if deleted > 0:
+            logging.info(f'Compacted {rollup} up to {compact_until}: {deleted} rows deleted')
 
-def get_latest_stored_data(msm_id, monitoring_goal, query_type, target, start_date):
     with connect_db() as connection:
         cursor = connection.cursor()
+
+        cursor.execute('PRAGMA auto_vacuum')
+        if cursor.fetchone()[0] != 2:
+            logging.info('The space of deleted rows is reused, but the DB file does not shrink. Run migrate_db.py to '
+                         'enable incremental auto vacuum')
+
+        # Gives the pages freed in the WAL back to the DB file
+        cursor.execute('PRAGMA wal_checkpoint(TRUNCATE)').fetchall()
+
+
+def split_time_frame(cursor, rollup, bin_width, start_date, end_date):
+    """Splits a time frame into parts that are read from the rollup and parts that are aggregated from the stored rows.
+
+    Only bins that are aggregated and that are completely inside the time frame are read from the rollup. The rows of
+    compacted bins have been deleted, so a time frame that starts or ends inside a compacted bin is widened to the
+    whole bin. Returns a list of (start, end, from_rollup).
+    """
+    watermark = get_watermark(cursor, rollup, bin_width)
+    compacted_until = get_compacted_until(cursor, rollup)
+
+    if watermark is not None and compacted_until is not None:
+        if start_date < compacted_until and start_date % bin_width != 0:
+            start_date = int(start_date) // bin_width * bin_width
+            logging.info(f'The time frame of {rollup} starts at {format_ts(start_date)}, as the results of the '
+                         f'compacted bins have been deleted')
+        if end_date < compacted_until - 1 and (end_date + 1) % bin_width != 0:
+            end_date = (int(end_date) // bin_width + 1) * bin_width - 1
+            logging.info(f'The time frame of {rollup} ends at {format_ts(end_date + 1)}, as the results of the '
+                         f'compacted bins have been deleted')
+
+    return split_at_watermark(watermark, bin_width, start_date, end_date)
+
+
+def split_at_watermark(watermark, width, start_date, end_date):
+    """Splits a time frame into the part that consists of whole periods of width before the watermark, and the parts
+    before and after it. Returns a list of (start, end, before_watermark)."""
+    start_date = math.ceil(start_date)
+    end_date = math.floor(end_date)
+
+    if watermark is None:
+        return [(start_date, end_date, False)]
+
+    first_bin = -(-start_date // width) * width
+    rollup_end = min(watermark, (end_date + 1) // width * width)
+    if first_bin >= rollup_end:
+        return [(start_date, end_date, False)]
+
+    parts = []
+    if start_date < first_bin:
+        parts.append((start_date, first_bin - 1, False))
+    parts.append((first_bin, rollup_end - 1, True))
+    if rollup_end <= end_date:
+        parts.append((rollup_end, end_date, False))
+
+    return parts
+
+
+@profiling.timed('db.aggregate')
+def get_vp_counts(msm_ids, monitoring_goal, query_type, zone, start_date, end_date):
+    """Counts the distinct VPs per time bin that see a key tag, and the distinct VPs per time bin in total.
+
+    Closed bins are read from the rollup, the other bins are aggregated from the stored rows. Returns rows of (bin,
+    target, flags, key_tag, vps) and rows of (bin, target, flags, vps). Bins are given as the timestamp of their start.
+    """
+    bin_width = get_bin_width(monitoring_goal, query_type, zone)
+    rollup = get_rollup_name(monitoring_goal, query_type, zone)
+    key_counts = []
+    total_counts = []
+
+    with connect_db() as connection:
+        cursor = connection.cursor()
+
+        for first_ts, last_ts, from_rollup in split_time_frame(cursor, rollup, bin_width, start_date, end_date):
+            if from_rollup:
+                cursor.execute('SELECT bin, target, flags, key_tag, vps FROM rollup_vp_counts '
+                               'WHERE rollup = ? AND bin >= ? AND bin <= ? AND key_tag IS NOT NULL',
+                               (rollup, first_ts, last_ts))
+                key_counts += cursor.fetchall()
+
+                cursor.execute('SELECT bin, target, flags, vps FROM rollup_vp_counts '
+                               'WHERE rollup = ? AND bin >= ? AND bin <= ? AND key_tag IS NULL',
+                               (rollup, first_ts, last_ts))
+                total_counts += cursor.fetchall()
+
+            else:
+                params = (*msm_ids, first_ts, last_ts, bin_width, bin_width)
+
+                cursor.execute(f'SELECT bin, target, flags, key_tag, COUNT(DISTINCT vp_id) '
+                               f'FROM ({select_binned_rows(msm_ids)}) '
+                               f'GROUP BY bin, target, flags, key_tag',
+                               params)
+                key_counts += cursor.fetchall()
+
+                cursor.execute(f'SELECT bin, target, flags, COUNT(DISTINCT vp_id) '
+                               f'FROM ({select_binned_rows(msm_ids)}) '
+                               f'GROUP BY bin, target, flags',
+                               params)
+                total_counts += cursor.fetchall()
+
+    return key_counts, total_counts
+
+
+@profiling.timed('db.aggregate')
+def get_return_code_counts(msm_ids, zone, start_date, end_date):
+    """Counts the trust chain responses per time bin, target, VP, return code and query type.
+
+    Closed bins are read from the rollup, the other bins are aggregated from the stored rows. Returns rows of (bin,
+    target, vp, return_code, query_type, responses).
+    """
+    bin_width = get_bin_width('trustchain', None, zone)
+    rollup = get_rollup_name('trustchain', None, zone)
+    counts = []
+
+    with connect_db() as connection:
+        cursor = connection.cursor()
+
+        for first_ts, last_ts, from_rollup in split_time_frame(cursor, rollup, bin_width, start_date, end_date):
+            if from_rollup:
+                cursor.execute('SELECT r.bin, r.target, v.vp, r.return_code, r.query_type, r.responses '
+                               'FROM rollup_return_codes r JOIN vps v ON v.vp_id = r.vp_id '
+                               'WHERE r.rollup = ? AND r.bin >= ? AND r.bin <= ?',
+                               (rollup, first_ts, last_ts))
+            else:
+                cursor.execute(f'SELECT b.bin, b.target, v.vp, b.return_code, b.query_type, COUNT(*) '
+                               f'FROM ({select_binned_rows(msm_ids)}) b JOIN vps v ON v.vp_id = b.vp_id '
+                               f'GROUP BY b.bin, b.target, v.vp, b.return_code, b.query_type',
+                               (*msm_ids, first_ts, last_ts, bin_width, bin_width))
+
+            counts += cursor.fetchall()
+
+    return counts
+
+
+def get_latest_stored_data(msm_id, monitoring_goal, query_type, target, zone, start_date):
+    """Returns (ts,) of the latest stored result of a measurement, or None if none is stored.
+
+    Compacted results count as stored, as they are aggregated already. The compaction deletes their rows, so the
+    measurement is stored up to the compacted bins of its rollup at least.
+    """
+    with connect_db() as connection:
+        cursor = connection.cursor()
+        # Seeks to the last entry of the measurement in the primary key (msm_id, ts) instead of sorting all rows
         cursor.execute('SELECT ts FROM measurement_data '
-                       'WHERE msm_id = ? and monitoring_goal = ? and query_type = ? and target = ? and ts >= ?'
-                       'ORDER BY ts DESC',
-                       (msm_id, monitoring_goal, query_type, target, start_date))
+                       'WHERE msm_id = ? and ts >= ? '
+                       'ORDER BY ts DESC LIMIT 1',
+                       (msm_id, start_date))
+        latest_ts = cursor.fetchone()
 
-        return cursor.fetchone()
+        compacted_until = get_compacted_until(cursor, get_rollup_name(monitoring_goal, query_type, zone))
+        if compacted_until is not None and compacted_until >= start_date and (
+                latest_ts is None or latest_ts[0] < compacted_until):
+            return (compacted_until,)
+
+        return latest_ts
+
+
+def get_responses(msm):
+    """Returns (destination address, abuf) of every response of a RIPE Atlas DNS result, like DnsResult does."""
+    responses = []
+
+    if 'result' in msm:
+        responses.append((msm.get('dst_addr'), msm['result'].get('abuf')))
+
+    for response in msm.get('resultset', []):
+        abuf = response['result'].get('abuf') if 'result' in response else response.get('abuf')
+        responses.append((response.get('dst_addr', msm.get('dst_addr')), abuf))
+
+    return responses
+
+
+def parse_measurement_fast(msm_id, monitoring_goal, zone, msm):
+    """Parses one RIPE Atlas result with the fast decoder, which only decodes the parts of the abuf that are needed.
+
+    Raises MalformedAbuf if the result cannot be decoded this way.
+    """
+    rows = []
+    # The records of the trust chain are not needed
+    if monitoring_goal == 'trustchain':
+        zone = None
+
+    for destination_address, abuf in get_responses(msm):
+        if abuf:
+            if destination_address is None:
+                raise MalformedAbuf('Response without destination address')
+
+            vp = str(msm['prb_id']) + '_' + destination_address
+            ts = int(msm['timestamp'])
+            return_code, records = parse_abuf(abuf, zone)
+
+            if monitoring_goal == 'pubdelay' or monitoring_goal == 'propdelay':
+                for record_type, rdata in records:
+                    if record_type == TYPE_DNSKEY:
+                        flags, protocol, algorithm = DNSKEY_HEADER.unpack_from(rdata)
+                        rows.append((msm_id, ts, vp, calc_keyid_wire(rdata), flags, algorithm, protocol, None))
+                    else:
+                        rows.append((msm_id, ts, vp, DS_KEY_TAG.unpack_from(rdata)[0], None, None, None, None))
+
+            elif monitoring_goal == 'trustchain':
+                rows.append((msm_id, ts, vp, -1, None, None, None, return_code))
+
+    return rows
+
+
+def parse_measurement(msm_id, monitoring_goal, zone, msm):
+    """Parses one RIPE Atlas result into rows of the measurement_data table (with the VP as string).
+
+    Results that the fast decoder cannot handle are parsed with sagan.
+    """
+    try:
+        return parse_measurement_fast(msm_id, monitoring_goal, zone, msm)
+    except (MalformedAbuf, AttributeError, KeyError, TypeError, ValueError) as e:
+        logging.debug(f'Parsing result of probe {msm.get("prb_id")} with sagan: {e}')
+
+    return parse_measurement_sagan(msm_id, monitoring_goal, zone, msm)
+
+
+def parse_measurement_sagan(msm_id, monitoring_goal, zone, msm):
+    """Parses one RIPE Atlas result with sagan."""
+    # Only needed for results that the fast decoder cannot handle
+    from ripe.atlas.sagan import DnsResult
+
+    rows = []
+    dns_result = DnsResult(msm)
+
+    if ~dns_result.is_error:
+
+        for response in dns_result.responses:
+            # if response.abuf is not None and not response.is_error:
+            if response.abuf is not None:
 
+                vp = str(dns_result.probe_id) + '_' + response.destination_address
+                ts = dns_result.created_timestamp
 
-def store_measurements_in_db(msm_id, monitoring_goal, query_type, target, msm_data):
+                if monitoring_goal == 'pubdelay' or monitoring_goal == 'propdelay':
+                    for answer in response.abuf.answers:
+                        vals = {}
+                        if 'Type' in answer.raw_data:
+                            if answer.raw_data['Type'] == 'DNSKEY' and answer.name == zone:
+                                vals['algorithm'] = answer.algorithm
+                                vals['protocol'] = answer.protocol
+                                vals['flags'] = answer.flags
+                                vals['key_tag'] = calc_keyid(answer.flags, answer.protocol,
+                                                             answer.algorithm, answer.key)
+
+                            elif (answer.raw_data['Type'] == 'DS') and answer.name == zone:
+                                vals['key_tag'] = answer.raw_data['Tag']
+
+                            if len(vals) > 0:
+                                rows.append((msm_id, ts, vp, vals['key_tag'], vals.get('flags'),
+                                             vals.get('algorithm'), vals.get('protocol'), None))
+
+                elif monitoring_goal == 'trustchain':
+                    # The same rule as parse_abuf(), whether or not sagan has extended the header already
+                    edns0 = response.abuf.edns0
+                    return_code = get_return_code(return_code_to_int(response.abuf.header.return_code),
+                                                  0 if edns0 is None else edns0.extended_return_code)
+                    rows.append((msm_id, ts, vp, -1, None, None, None, return_code))
+
+    return rows
+
+
+def get_vp_ids(cursor, vp_ids, vps):
+    """Adds the IDs of the given VPs to vp_ids. VPs that are not in the DB yet are added to the 'vps' table."""
+    unknown_vps = {vp for vp in vps if vp not in vp_ids}
+
+    if len(unknown_vps) > 0:
+        cursor.executemany('INSERT OR IGNORE INTO vps (vp) VALUES (?)', [(vp,) for vp in unknown_vps])
+        cursor.execute('SELECT vp, vp_id FROM vps')
+        vp_ids.update(cursor.fetchall())
+
+
+def insert_rows(cursor, vp_ids, rows):
+    """Inserts rows into the measurement_data table and returns how many of them were new."""
+    get_vp_ids(cursor, vp_ids, [row[2] for row in rows])
+
+    cursor.executemany('INSERT OR IGNORE INTO measurement_data '
+                       '(msm_id, ts, vp_id, key_tag, flags, algorithm, protocol, return_code) '
+                       'VALUES (?, ?, ?, ?, ?, ?, ?, ?)',
+                       [(msm_id, ts, vp_ids[vp], *vals) for msm_id, ts, vp, *vals in rows])
+
+    return cursor.rowcount
+
+
+def init_parse_worker():
+    # Hides the warnings of sagan about erroneous responses, as the main process does while storing results
+    logging.getLogger().setLevel(logging.ERROR)
+
+
+def get_parse_pool(workers):
+    """Returns the process pool that parses measurement results. The pool is created on first use."""
+    global parse_pool
+
+    if parse_pool is None:
+        # Processes are spawned instead of forked, as downloads may be running in other threads
+        parse_pool = ProcessPoolExecutor(max_workers=workers, mp_context=multiprocessing.get_context('spawn'),
+                                         initializer=init_parse_worker)
+
+    return parse_pool
+
+
+def parse_measurements(msm_id, monitoring_goal, zone, msm_data):
+    """Parses a chunk of RIPE Atlas results into rows of the measurement_data table."""
+    rows = []
+    for msm in msm_data:
+        rows += parse_measurement(msm_id, monitoring_goal, zone, msm)
+
+    return rows
+
+
+def parse_in_batches(msm_id, monitoring_goal, zone, msm_data, batch_size):
+    """Parses RIPE Atlas results and yields the rows in batches.
+
+    If 'parse_workers' is larger than 1, chunks of results are parsed in a pool of processes. The batches are still
+    yielded in the order of the results, so that a single writer can insert them.
+    """
+    workers = config['DATABASE'].getint('parse_workers', fallback=1)
+
+    if workers <= 1:
+        rows = []
+        start = time.perf_counter()
+        for msm in msm_data:
+            rows += parse_measurement(msm_id, monitoring_goal, zone, msm)
+
+            if len(rows) >= batch_size:
+                profiling.add_time('db.parse', time.perf_counter() - start)
+                yield rows
+                rows = []
+                start = time.perf_counter()
+
+        profiling.add_time('db.parse', time.perf_counter() - start)
+        if len(rows) > 0:
+            yield rows
+
+    else:
+        pool = get_parse_pool(workers)
+        chunk_size = config['DATABASE'].getint('parse_chunk_size', fallback=500)
+
+        # Keeps every worker busy, while limiting how many parsed chunks wait for the writer
+        pending = deque()
+        for chunk in itertools.batched(msm_data, chunk_size):
+            pending.append(pool.submit(parse_measurements, msm_id, monitoring_goal, zone, chunk))
+
+            if len(pending) >= workers * 2:
+                yield wait_for_chunk(pending.popleft())
+
+        while len(pending) > 0:
+            yield wait_for_chunk(pending.popleft())
+
+
+def wait_for_chunk(future):
+    # The parsing itself runs in the workers, this is the time the writer waits for them
+    with profiling.span('db.parse_wait'):
+        return future.result()
+
+
+def store_measurements_in_db(msm_id, monitoring_goal, query_type, target, zone, msm_data):
+    """Stores measurement results in the DB.
+
+    The rows are inserted in batches of 'batch_size' and committed in a single transaction. Returns the number of
+    inserted rows and the number of rows that were ignored because they were already stored.
+    """
     logging.info('Storing measurement into DB')
     logging.getLogger().setLevel(logging.ERROR)
 
+    batch_size = config['DATABASE'].getint('batch_size', fallback=10000)
+    rollup = get_rollup_name(monitoring_goal, query_type, zone)
+    inserted = 0
+    ignored = 0
+    dropped = 0
+
     with connect_db() as connection:
         cursor = connection.cursor()
 
-        for msm in msm_data:
-            dns_result = DnsResult(msm)
-
-            if ~dns_result.is_error:
-
-                for response in dns_result.responses:
-                    # if response.abuf is not None and not response.is_error:
-                    if response.abuf is not None:
-
-                        vp = str(dns_result.probe_id) + '_' + response.destination_address
-                        ts = dns_result.created_timestamp
-
-                        if monitoring_goal == 'pubdelay' or monitoring_goal == 'propdelay':
-                            for answer in response.abuf.answers:
-                                vals = {}
-                                if 'Type' in answer.raw_data:
-                                    if answer.raw_data['Type'] == 'DNSKEY' and answer.name == config['ROLLOVER'][
-                                        'zone']:
-                                        vals['algorithm'] = answer.algorithm
-                                        vals['protocol'] = answer.protocol
-                                        vals['flags'] = answer.flags
-                                        vals['key_tag'] = calc_keyid(answer.flags, answer.protocol,
-                                                                     answer.algorithm, answer.key)
-
-                                    elif (answer.raw_data['Type'] == 'DS') and answer.name == config['ROLLOVER'][
-                                        'zone']:
-                                        vals['key_tag'] = answer.raw_data['Tag']
-
-                                    if len(vals) > 0:
-                                        logging.debug((msm_id, monitoring_goal, query_type, target, ts, vp, str(vals)))
-                                        cursor.execute(
-                                            'INSERT OR IGNORE INTO measurement_data VALUES (?, ?, ?, ?, ?, ?, ?)',
-                                            (msm_id, monitoring_goal, query_type, target, ts, vp, json.dumps(vals)))
-
-                        elif monitoring_goal == 'trustchain':
-                            vals = {}
-                            return_code = response.abuf.header.return_code
-                            vals['return_code'] = return_code
+        # The rows of compacted bins have been deleted. Results of these bins (e.g. of old dumps) could neither be
+        # aggregated again nor be added to the aggregates, as they might have been counted already.
+        compacted_until = get_compacted_until(cursor, rollup)
 
-                            if len(vals) > 0:
-                                logging.debug((msm_id, monitoring_goal, query_type, target, ts, vp, str(vals)))
-                                cursor.execute('INSERT OR IGNORE INTO measurement_data VALUES (?, ?, ?, ?, ?, ?, ?)',
-                                               (msm_id, monitoring_goal, query_type, target, ts, vp, json.dumps(vals)))
+        vp_ids = {}
+        first_ts = None
+        for rows in parse_in_batches(msm_id, monitoring_goal, zone, msm_data, batch_size):
+            if compacted_until is not None:
+                kept = [row for row in rows if row[1] >= compacted_until]
+                dropped += len(rows) - len(kept)
+                rows = kept
+
+            with profiling.span('db.insert'):
+                new_rows = insert_rows(cursor, vp_ids, rows)
+            inserted += new_rows
+            ignored += len(rows) - new_rows
 
+            if new_rows > 0:
+                batch_first_ts = min(row[1] for row in rows)
+                first_ts = batch_first_ts if first_ts is None else min(first_ts, batch_first_ts)
+
+        # Results of bins that have already been aggregated, e.g. results that arrived late
+        if first_ts is not None:
+            rewind_rollup(cursor, rollup, first_ts)
+
+        with profiling.span('db.commit'):
             connection.commit()
 
+    profiling.count('db.rows_inserted', inserted)
+    profiling.count('db.rows_ignored', ignored)
+    profiling.count('db.rows_dropped', dropped)
+
     logging.getLogger().setLevel(log_level_info[config['OUTPUT']['loglevel']])
+    logging.info(f'Stored measurements of {msm_id}: {inserted} rows inserted, {ignored} rows already stored')
+    if dropped > 0:
+        logging.warning(f'Dropped {dropped} rows of {msm_id} before {format_ts(compacted_until)}, as the bins of '
+                        f'{rollup} have been compacted up to there')
+
+    return inserted, ignored
 
 
 def store_excluded_vps(vps):
@@ -157,6 +828,21 @@ def store_excluded_vps(vps):
             cursor.execute('INSERT OR IGNORE INTO excluded_vps (vp) VALUES (?)',
                            (vp,))
 
+        # The rollups count the results of VPs that are excluded now
+        clear_rollups(cursor)
+
+        # Compacted bins are kept. The responses of the trust chain are counted per VP, so those of excluded VPs can
+        # be dropped from them. The VP counts of the other rollups cannot be corrected.
+        cursor.execute('DELETE FROM rollup_return_codes '
+                       'WHERE vp_id IN (SELECT v.vp_id FROM excluded_vps e JOIN vps v ON v.vp = e.vp)')
+        cursor.execute('SELECT rollup, ts FROM rollup_compactions')
+        for rollup, compacted_until in cursor.fetchall():
+            if rollup.startswith('trustchain@'):
+                drop_cached_days(rollup, 0)
+            else:
+                logging.warning(f'Excluded VPs are still counted in the compacted bins of {rollup} before '
+                                f'{format_ts(compacted_until)}')
+
         connection.commit()
 
 
@@ -177,5 +863,3 @@ def stop_measurement(msm_id):
     cursor.execute('UPDATE measurements SET running = 0 WHERE msm_id = ?', (msm_id,))
 
     connection.commit()
-
-    connection.close()
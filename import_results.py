@@ -0,0 +1,161 @@
+import argparse
+import codecs
+import gzip
+import json
+import logging
+import mmap
+import re
+from misc.config import config
+from misc import profiling
+import database
+
+logging.basicConfig(level=logging.INFO)
+
+GZIP_MAGIC = b'\x1f\x8b'
+# Whitespace and commas between the elements of a JSON array
+SEPARATORS = re.compile(r'[\s,]*')
+# What follows the position of a decoding error if the element is only cut off by the end of the buffer: the start of
+# a number, literal or \u escape
+CUT_OFF_TOKEN = re.compile(r'[\w.+\-]*')
+CHUNK_SIZE = 4 * 2 ** 20
+
+
+def open_dump(mapped):
+    """Returns a binary file object of a memory mapped dump, which decompresses gzip compressed dumps on the fly."""
+    if mapped[:2] == GZIP_MAGIC:
+        return gzip.GzipFile(fileobj=mapped, mode='rb')
+
+    return mapped
+
+
+def is_json_array(dump):
+    """Checks if a dump is a JSON array (as returned by the results API) rather than one result per line (NDJSON)."""
+    start = dump.read(1024).lstrip()
+    dump.seek(0)
+
+    return start.startswith(b'[')
+
+
+def iter_ndjson(dump):
+    for line in iter(dump.readline, b''):
+        if line.strip():
+            yield json.loads(line)
+
+
+def is_cut_off(buffer, error):
+    """Checks if a decoding error is caused by the end of the buffer, rather than by a malformed element."""
+    if error.msg.startswith('Unterminated string'):
+        return True
+
+    return CUT_OFF_TOKEN.fullmatch(buffer, error.pos) is not None
+
+
+def iter_json_array(dump):
+    """Yields the elements of a JSON array one by one, while reading the dump in chunks."""
+    decoder = json.JSONDecoder()
+    utf8 = codecs.getincrementaldecoder('utf-8')()
+
+    buffer = utf8.decode(dump.read(CHUNK_SIZE))
+    offset = buffer.index('[') + 1
+    eof = False
+
+    while True:
+        offset = SEPARATORS.match(buffer, offset).end()
+
+        if offset < len(buffer):
+            if buffer[offset] == ']':
+                return
+
+            try:
+                result, offset = decoder.raw_decode(buffer, offset)
+                yield result
+                continue
+            except json.JSONDecodeError as e:
+                # The element continues in the next chunk, unless the dump has been read completely. Malformed
+                # elements are reported right away instead of after reading the rest of the dump.
+                if eof or not is_cut_off(buffer, e):
+                    raise
+
+        elif eof:
+            raise ValueError('The JSON array is not terminated')
+
+        chunk = dump.read(CHUNK_SIZE)
+        eof = len(chunk) == 0
+        buffer = buffer[offset:] + utf8.decode(chunk, final=eof)
+        offset = 0
+
+
+def import_dump(path, msm_attributes, batch_size):
+    """Stores the results of a dump of the measurements in msm_attributes. Returns the number of stored results per
+    measurement and the number of skipped results per unknown measurement."""
+    imported = {}
+    skipped = {}
+    batches = {}
+
+    with open(path, 'rb') as f:
+        if f.seek(0, 2) == 0:
+            logging.warning(f'{path} is empty')
+            return imported, skipped
+
+        # The dump is read through a memory map, so that it is not copied through a buffer of the process
+        with mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) as mapped, open_dump(mapped) as dump:
+            mapped.madvise(mmap.MADV_SEQUENTIAL)
+            results = iter_json_array(dump) if is_json_array(dump) else iter_ndjson(dump)
+
+            for result in results:
+                msm_id = result.get('msm_id')
+                if msm_id not in msm_attributes:
+                    skipped[msm_id] = skipped.get(msm_id, 0) + 1
+                    continue
+
+                batch = batches.setdefault(msm_id, [])
+                batch.append(result)
+                if len(batch) >= batch_size:
+                    store_batch(msm_id, msm_attributes, batches.pop(msm_id), imported)
+
+            for msm_id, batch in batches.items():
+                store_batch(msm_id, msm_attributes, batch, imported)
+
+    return imported, skipped
+
+
+def store_batch(msm_id, msm_attributes, batch, imported):
+    monitoring_goal, query_type, target, _, zone = msm_attributes[msm_id]
+    database.store_measurements_in_db(msm_id, monitoring_goal, query_type, target, zone, batch)
+
+    imported[msm_id] = imported.get(msm_id, 0) + len(batch)
+    profiling.count('import.results', len(batch))
+
+
+def import_dumps(paths):
+    """Stores the results of local RIPE Atlas result dumps in the DB, without fetching anything from RIPE Atlas.
+
+    Only results of measurements in the 'measurements' table are stored, as their monitoring goal, query type and
+    target are taken from there.
+    """
+    _, msm_attributes = database.get_all_measurements()
+    batch_size = config['DATABASE'].getint('import_batch_size', fallback=10000)
+
+    for path in paths:
+        logging.info(f'Importing {path}')
+        with profiling.span('import.dump'):
+            imported, skipped = import_dump(path, msm_attributes, batch_size)
+
+        for msm_id, results in sorted(imported.items()):
+            logging.info(f'{path}: {results} results of {msm_id}')
+        for msm_id, results in skipped.items():
+            logging.warning(f'{path}: Skipped {results} results of {msm_id}, which is not in the measurements table')
+
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Imports RIPE Atlas result dumps into the DB.')
+    parser.add_argument('dumps', nargs='+', help='JSON arrays or one result per line (NDJSON), optionally gzip '
+                                                 'compressed')
+    parser.add_argument('--profile', help='Writes the time spent per phase and counters as JSON to this file')
+    args = parser.parse_args()
+
+    try:
+        import_dumps(args.dumps)
+    finally:
+        if args.profile is not None:
+            profiling.write_report(args.profile)
@@ -4,6 +4,82 @@ import logging
 
 logging.basicConfig(level=logging.DEBUG)
 
+MEASUREMENTS_TABLE = '''CREATE TABLE measurements 
+                        (msm_id int PRIMARY KEY, 
+                        monitoring_goal text, 
+                        query_type text, 
+                        target text, 
+                        ts int, 
+                        running bool,
+                        zone text);'''
+
+# Monitoring goal, query type and target of a row are defined by its measurement (msm_id) and VPs are stored in the
+# 'vps' table. Trust chain measurements have no key tag and use -1 instead.
+MEASUREMENT_DATA_TABLE = '''CREATE TABLE measurement_data (
+                        msm_id int NOT NULL, 
+                        ts int NOT NULL, 
+                        vp_id int NOT NULL,
+                        key_tag int NOT NULL,
+                        flags int,
+                        algorithm int,
+                        protocol int,
+                        return_code int,
+                        PRIMARY KEY (msm_id, ts, vp_id, key_tag)
+                        ) WITHOUT ROWID;'''
+
+VPS_TABLE = '''CREATE TABLE vps (
+                        vp_id integer PRIMARY KEY,
+                        vp text UNIQUE
+                        );'''
+
+EXCLUDED_VPS_TABLE = '''CREATE TABLE excluded_vps (
+                           vp text,
+                           PRIMARY KEY (vp)
+                           );'''
+
+# Aggregates of closed time bins, maintained at ingestion time. A rollup is named after the monitoring goal, query
+# type and zone it aggregates (e.g. 'pubdelay_dnskey@nl.' or 'trustchain@nl.'). Rows without key tag count the VPs of
+# all key tags.
+ROLLUP_TABLES = ['CREATE TABLE IF NOT EXISTS rollup_vp_counts ('
+                 'rollup text NOT NULL, '
+                 'bin int NOT NULL, '
+                 'target text, '
+                 'flags int, '
+                 'key_tag int, '
+                 'vps int);',
+                 'CREATE TABLE IF NOT EXISTS rollup_return_codes ('
+                 'rollup text NOT NULL, '
+                 'bin int NOT NULL, '
+                 'target text, '
+                 'vp_id int, '
+                 'return_code int, '
+                 'query_type text, '
+                 'responses int);',
+                 # Every bin before 'ts' has been aggregated
+                 'CREATE TABLE IF NOT EXISTS rollup_watermarks ('
+                 'rollup text PRIMARY KEY, '
+                 'bin_width int NOT NULL, '
+                 'ts int NOT NULL);',
+                 # Every bin before 'ts' has been compacted: its rows have been deleted from measurement_data
+                 'CREATE TABLE IF NOT EXISTS rollup_compactions ('
+                 'rollup text PRIMARY KEY, '
+                 'ts int NOT NULL);',
+                 # A cell is stored once per bin. Missing flags, key tags and return codes are NULL, which UNIQUE
+                 # would treat as distinct from each other.
+                 'CREATE UNIQUE INDEX IF NOT EXISTS rollup_vp_counts_key ON rollup_vp_counts '
+                 '(rollup, bin, target, coalesce(flags, -1), coalesce(key_tag, -1));',
+                 'CREATE UNIQUE INDEX IF NOT EXISTS rollup_return_codes_key ON rollup_return_codes '
+                 '(rollup, bin, target, vp_id, coalesce(return_code, -1), query_type);']
+
+# Keys of the cells of the rollups, as in their unique indexes
+ROLLUP_KEYS = {'rollup_vp_counts': 'rollup, bin, target, flags, key_tag',
+               'rollup_return_codes': 'rollup, bin, target, vp_id, return_code, query_type'}
+
+# Lookups of measurement_data by measurement and time use its primary key (msm_id, ts, ...)
+INDEXES = ['CREATE INDEX IF NOT EXISTS measurements_goal_idx ON measurements (monitoring_goal, query_type);',
+           'CREATE INDEX IF NOT EXISTS measurements_zone_idx ON measurements (zone, monitoring_goal, query_type);',
+           'CREATE INDEX IF NOT EXISTS measurements_ts_idx ON measurements (ts);']
+
 
 def connect_db():
     return sqlite3.connect(config['DATABASE']['db_path'])
@@ -11,47 +87,41 @@ def connect_db():
 
 def init_table():
     connection = connect_db()
+    # Lets the compaction give the space of deleted rows back to the file system. Only works before tables exist.
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('PRAGMA journal_mode = WAL')
     cursor = connection.cursor()
 
-    try:
-        cursor.execute('''CREATE TABLE measurements 
-                        (msm_id int PRIMARY KEY, 
-                        monitoring_goal text, 
-                        query_type text, 
-                        target text, 
-                        ts int, 
-                        running bool);''')
+    for table in [MEASUREMENTS_TABLE, MEASUREMENT_DATA_TABLE, VPS_TABLE, EXCLUDED_VPS_TABLE]:
+        try:
+            cursor.execute(table)
+            connection.commit()
+        except sqlite3.OperationalError as e:
+            logging.error(e)
 
-        connection.commit()
-    except sqlite3.OperationalError as e:
-        logging.error(e)
+    create_indexes(connection)
+    create_rollup_tables(connection)
 
-    try:
-        cursor.execute('''CREATE TABLE measurement_data (
-                        msm_id int, 
-                        monitoring_goal text, 
-                        query_type text, 
-                        target text, 
-                        ts int, 
-                        vp text,
-                        vals text,
-                        PRIMARY KEY (msm_id, monitoring_goal, query_type, target, ts, vp, vals)
-                        );''')
-        connection.commit()
-    except sqlite3.OperationalError as e:
-        logging.error(e)
-
-    try:
-        cursor.execute('''CREATE TABLE excluded_vps (
-                           vp text,
-                           PRIMARY KEY (vp)
-                           );''')
-        connection.commit()
+    connection.close()
 
-    except sqlite3.OperationalError as e:
-        logging.error(e)
 
-    connection.close()
+def create_indexes(connection):
+    cursor = connection.cursor()
+
+    for index in INDEXES:
+        cursor.execute(index)
+
+    connection.commit()
+
+
+def create_rollup_tables(connection):
+    cursor = connection.cursor()
+
+    for statement in ROLLUP_TABLES:
+        cursor.execute(statement)
+
+    connection.commit()
 
 
-init_table()
+if __name__ == '__main__':
+    init_table()
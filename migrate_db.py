@@ -0,0 +1,137 @@
+import os
+import shutil
+import sqlite3
+import columnar_cache
+from misc.config import config, get_default_zone
+from misc.tools import RETURN_CODES
+import init_db
+import logging
+
+logging.basicConfig(level=logging.INFO)
+
+
+def get_columns(cursor, table):
+    cursor.execute(f'PRAGMA table_info({table})')
+
+    return [row[1] for row in cursor.fetchall()]
+
+
+def migrate_measurement_data(connection):
+    """Moves measurement_data from the text based layout (with a JSON 'vals' column) to the compact layout."""
+    cursor = connection.cursor()
+
+    if 'vals' not in get_columns(cursor, 'measurement_data'):
+        logging.info('measurement_data already has the compact layout')
+        return
+
+    logging.info('Migrating measurement_data to the compact layout')
+
+    return_codes = ' '.join(f"WHEN '{name}' THEN {code}" for name, code in RETURN_CODES.items())
+
+    # Either the whole migration succeeds or the DB stays as it is
+    cursor.execute('BEGIN')
+    cursor.execute('ALTER TABLE measurement_data RENAME TO measurement_data_old')
+
+    cursor.execute(init_db.VPS_TABLE)
+    cursor.execute(init_db.MEASUREMENT_DATA_TABLE)
+
+    cursor.execute('INSERT OR IGNORE INTO vps (vp) SELECT DISTINCT vp FROM measurement_data_old')
+
+    cursor.execute('INSERT OR IGNORE INTO measurement_data '
+                   '(msm_id, ts, vp_id, key_tag, flags, algorithm, protocol, return_code) '
+                   'SELECT o.msm_id, o.ts, v.vp_id, '
+                   "coalesce(json_extract(o.vals, '$.key_tag'), -1), "
+                   "json_extract(o.vals, '$.flags'), "
+                   "json_extract(o.vals, '$.algorithm'), "
+                   "json_extract(o.vals, '$.protocol'), "
+                   f"CASE json_extract(o.vals, '$.return_code') {return_codes} "
+                   "ELSE json_extract(o.vals, '$.return_code') END "
+                   'FROM measurement_data_old o JOIN vps v ON v.vp = o.vp')
+    logging.info(f'Migrated {cursor.rowcount} rows')
+
+    cursor.execute('DROP TABLE measurement_data_old')
+    connection.commit()
+
+
+def migrate_zones(connection):
+    """Adds the zone to the measurements and rollups of DBs from before several zones could be monitored. Their
+    measurements belong to the zone of [ROLLOVER]."""
+    cursor = connection.cursor()
+
+    if 'zone' in get_columns(cursor, 'measurements'):
+        logging.info('measurements already have a zone')
+        return
+
+    zone = get_default_zone()
+    logging.info(f'Assigning every measurement to {zone}')
+
+    cursor.execute('BEGIN')
+    cursor.execute('ALTER TABLE measurements ADD COLUMN zone text')
+    cursor.execute('UPDATE measurements SET zone = ?', (zone,))
+
+    # Rollups are named after their zone as well, e.g. 'trustchain' becomes 'trustchain@nl.'
+    cursor.execute("SELECT rollup FROM rollup_watermarks WHERE instr(rollup, '@') = 0")
+    rollups = [row[0] for row in cursor.fetchall()]
+    for table in ['rollup_vp_counts', 'rollup_return_codes', 'rollup_watermarks', 'rollup_compactions']:
+        cursor.execute(f"UPDATE {table} SET rollup = rollup || '@' || ? WHERE instr(rollup, '@') = 0", (zone,))
+
+    connection.commit()
+
+    # The columnar cache keeps the days of a rollup in a directory named after it
+    cache_dir = columnar_cache.get_cache_dir()
+    if cache_dir is None:
+        return
+
+    for rollup in rollups:
+        directory = os.path.join(cache_dir, rollup)
+        if not os.path.isdir(directory):
+            continue
+
+        if os.path.exists(os.path.join(cache_dir, f'{rollup}@{zone}')):
+            # Written by a newer version already, the old days are not needed
+            shutil.rmtree(directory)
+        else:
+            os.rename(directory, os.path.join(cache_dir, f'{rollup}@{zone}'))
+
+
+def migrate_rollup_keys(connection):
+    """Removes the cells that concurrent rollup updates of older versions stored twice, so that the unique indexes of
+    the rollups can be created. The duplicates are identical, as they were aggregated from the same rows."""
+    cursor = connection.cursor()
+
+    for table, key in init_db.ROLLUP_KEYS.items():
+        if len(get_columns(cursor, table)) == 0:
+            continue
+
+        cursor.execute(f'DELETE FROM {table} WHERE rowid NOT IN (SELECT min(rowid) FROM {table} GROUP BY {key})')
+        if cursor.rowcount > 0:
+            logging.info(f'Removed {cursor.rowcount} duplicate cells from {table}')
+
+        # Replaced by the unique index
+        cursor.execute(f'DROP INDEX IF EXISTS {table}_idx')
+
+    connection.commit()
+
+
+def migrate_db():
+    db_path = config['DATABASE']['db_path']
+    size_before = os.path.getsize(db_path)
+
+    connection = sqlite3.connect(db_path)
+    migrate_measurement_data(connection)
+    migrate_rollup_keys(connection)
+    init_db.create_rollup_tables(connection)
+    migrate_zones(connection)
+    init_db.create_indexes(connection)
+
+    # Gives the space of the old layout back to the file system. Incremental auto vacuum lets the compaction do the same
+    # for the rows that it deletes, and only takes effect with a VACUUM on existing DBs.
+    connection.execute('PRAGMA auto_vacuum = INCREMENTAL')
+    connection.execute('VACUUM')
+    connection.close()
+
+    logging.info(f'DB size: {size_before / 2 ** 20:.1f} MB before, {os.path.getsize(db_path) / 2 ** 20:.1f} MB after')
+
+
+if __name__ == '__main__':
+    migrate_db()
@@ -3,14 +3,21 @@ import argparse
 parser = argparse.ArgumentParser(description='Rollover Monitor CLI.')
 group = parser.add_mutually_exclusive_group()
 
-parser.add_argument("target", help="Defines, what you want to monitor. Options are: 'pubdelay', 'propdelay', 'trustchain' or 'groundtruth'.")
+parser.add_argument("target", help="Defines, what you want to monitor. Options are: 'pubdelay', 'propdelay', 'trustchain', 'groundtruth' or 'daemon' (keeps the DB up to date with the results of every running measurement).")
 parser.add_argument("--record", help="'dnskey' or 'ds'. Required when target is 'pubdelay' or 'propdelay'.")
+parser.add_argument("--zone", help="Zone to monitor, either the zone of [ROLLOVER] (default) or a zone with sections of its own in the config, e.g. [CHILDREN example.nl.]. Not used by the target 'daemon', which covers every zone.")
 
 group.add_argument("--start", help="Start monitoring", action="store_true")
 group.add_argument("--stop", help="Stop monitoring", action="store_true")
 group.add_argument("--status", help="Get monitoring state (of the last 60 minutes by default)", action="store_true")
 parser.add_argument("--silent", help="Hide output", action="store_true")
 
+parser.add_argument("--no-fetch", help="Only analyze stored results, without fetching new ones from RIPE Atlas. Only in combination with --status", action="store_true")
+parser.add_argument("--stream", help="Receive results from the RIPE Atlas result stream instead of polling them. Only in combination with the target 'daemon'", action="store_true")
 parser.add_argument("--json", help="Returns monitoring state in json.", action="store_true")
+parser.add_argument("--ndjson", help="Returns monitoring state as one json object per time bin and line. Implies --json", action="store_true")
+parser.add_argument("--output", help="Writes the json to this file instead of the command line")
 parser.add_argument("--start-date", help="Date of the first measurement (Y-m-d H:M 24h). Only in combination with --status and --start")
-parser.add_argument("--stop-date", help="Date of the last measurement. Only in combination with --status and --start")
\ No newline at end of file
+parser.add_argument("--stop-date", help="Date of the last measurement. Only in combination with --status and --start")
+parser.add_argument("--profile", help="Writes the time spent per phase (download, parsing, inserts, aggregation, json, plots) and counters of results, rows and bytes as JSON to this file")
+parser.add_argument("--cprofile", help="Runs cProfile and dumps its statistics to this file. Slows down the run, unlike --profile")
@@ -2,3 +2,42 @@ import configparser
 
 config = configparser.ConfigParser(allow_no_value=True)
 config.read('config.ini')
+
+# Sections that can be given per zone, e.g. '[CHILDREN example.nl.]'
+ZONE_SECTIONS = ['TTLS', 'MEASUREMENTS', 'CHILDREN', 'PARENTS']
+
+# Sections that list the name servers of a zone. A zone's own section replaces them, the settings of the other sections
+# are taken from the section of every zone if the zone's own section does not have them.
+NAME_SERVER_SECTIONS = ['CHILDREN', 'PARENTS']
+
+
+def get_default_zone():
+    return config['ROLLOVER']['zone']
+
+
+def get_zones():
+    """Returns the zone of [ROLLOVER], the zones listed in 'zones' and every zone that has sections of its own."""
+    zones = [get_default_zone()]
+
+    for zone in config['ROLLOVER'].get('zones', fallback='').replace(',', ' ').split():
+        if zone not in zones:
+            zones.append(zone)
+
+    for section in config.sections():
+        name, _, zone = section.partition(' ')
+        if name in ZONE_SECTIONS and zone and zone not in zones:
+            zones.append(zone)
+
+    return zones
+
+
+def get_zone_section(section, zone):
+    """Returns the section of a zone if the config has one (e.g. '[TTLS example.nl.]'), otherwise the section that
+    applies to every zone (e.g. '[TTLS]'). Settings missing from the section of the zone are taken from the section of
+    every zone."""
+    if not config.has_section(f'{section} {zone}'):
+        return config[section]
+    elif section in NAME_SERVER_SECTIONS:
+        return config[f'{section} {zone}']
+
+    return {**config[section], **config[f'{section} {zone}']}
@@ -0,0 +1,113 @@
+import base64
+import struct
+
+TYPE_OPT = 41
+TYPE_DS = 43
+TYPE_DNSKEY = 48
+
+HEADER = struct.Struct('!HHHHHH')
+RR = struct.Struct('!HHIH')
+
+# Printable ASCII characters without '"' and '\\'
+PLAIN_CHARACTERS = bytes(o for o in range(ord(' '), ord('~') + 1) if o not in b'"\\')
+
+
+class MalformedAbuf(ValueError):
+    """Raised if an abuf cannot be decoded."""
+
+
+def get_return_code(header_return_code, extended_return_code):
+    """Returns the return code of a response: the 4 bits of the header, extended by the 8 bits of the EDNS0 OPT record
+    (RFC 6891) if the response has one."""
+
+    return (header_return_code & 0x0F) | (extended_return_code << 4)
+
+
+def skip_name(buf, offset):
+    """Returns the offset after the (possibly compressed) domain name at offset."""
+
+    while True:
+        length = buf[offset]
+        if length == 0:
+            return offset + 1
+        elif length >= 0xC0:
+            return offset + 2
+        elif length > 63:
+            raise MalformedAbuf(f'Bad label length {length} at offset {offset}')
+
+        offset += length + 1
+
+
+def read_name(buf, offset):
+    """Returns the domain name at offset in presentation format (e.g. 'nl.')."""
+
+    labels = []
+    jumps = 0
+    while True:
+        length = buf[offset]
+        if length == 0:
+            break
+        elif length >= 0xC0:
+            jumps += 1
+            if jumps > 127:
+                raise MalformedAbuf(f'Compression loop at offset {offset}')
+            offset = ((length & 0x3F) << 8) | buf[offset + 1]
+            continue
+        elif length > 63:
+            raise MalformedAbuf(f'Bad label length {length} at offset {offset}')
+
+        label = buf[offset + 1:offset + length + 1]
+        # Labels with characters that sagan escapes are left to sagan
+        if len(label) != length or label.translate(None, PLAIN_CHARACTERS):
+            raise MalformedAbuf(f'Unsupported label at offset {offset}')
+
+        labels.append(label.decode('ascii'))
+        offset += length + 1
+
+    return '.'.join(labels) + '.'
+
+
+def parse_abuf(abuf, zone=None):
+    """Decodes the parts of a base64 encoded DNS response that are relevant to monitor rollovers.
+
+    Returns the return code (including the extended return code of EDNS0) and a list of (type, rdata) of the DNSKEY
+    and DS records in the answer section that belong to zone. Every other record is skipped without decoding it.
+    """
+
+    buf = base64.b64decode(abuf)
+
+    try:
+        _, flags, qdcount, ancount, nscount, arcount = HEADER.unpack_from(buf, 0)
+        return_code = get_return_code(flags, 0)
+        offset = HEADER.size
+
+        for _ in range(qdcount):
+            offset = skip_name(buf, offset) + 4
+        if offset > len(buf):
+            raise MalformedAbuf('Question section exceeds the buffer')
+
+        records = []
+        for idx in range(ancount + nscount + arcount):
+            name_offset = offset
+            offset = skip_name(buf, offset)
+            rr_type, _, ttl, rd_length = RR.unpack_from(buf, offset)
+            offset += RR.size
+
+            rdata = buf[offset:offset + rd_length]
+            if len(rdata) != rd_length:
+                raise MalformedAbuf(f'Record {idx} exceeds the buffer')
+            offset += rd_length
+
+            if rr_type == TYPE_OPT:
+                return_code = get_return_code(return_code, ttl >> 24)
+
+            elif idx < ancount and zone is not None and (rr_type == TYPE_DNSKEY or rr_type == TYPE_DS):
+                if rd_length < 4:
+                    raise MalformedAbuf(f'Record {idx} is too short')
+                if read_name(buf, name_offset) == zone:
+                    records.append((rr_type, rdata))
+
+    except (IndexError, struct.error) as e:
+        raise MalformedAbuf(e)
+
+    return return_code, records
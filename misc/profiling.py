@@ -0,0 +1,96 @@
+import cProfile
+import functools
+import json
+import threading
+import time
+from contextlib import contextmanager
+
+# Spans and counters are always recorded. A span costs two clock reads and a dict update, so they are only placed
+# around whole phases and batches, never around single results.
+spans = {}
+counters = {}
+lock = threading.Lock()
+started = time.perf_counter()
+profiler = None
+
+
+def add_time(name, seconds):
+    """Adds the duration (in seconds) of one run of a phase to the span name."""
+    with lock:
+        span_stats = spans.get(name)
+        if span_stats is None:
+            spans[name] = [1, seconds, seconds]
+        else:
+            span_stats[0] += 1
+            span_stats[1] += seconds
+            span_stats[2] = max(span_stats[2], seconds)
+
+
+@contextmanager
+def span(name):
+    """Measures the time spent in the with block as one run of the phase name."""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        add_time(name, time.perf_counter() - start)
+
+
+def timed(name):
+    """Decorates a function, so that every call is measured as one run of the phase name."""
+
+    def decorator(function):
+        @functools.wraps(function)
+        def wrapper(*args, **kwargs):
+            with span(name):
+                return function(*args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+def count(name, value=1):
+    """Increments the counter name, e.g. by the number of results, rows or bytes of a batch."""
+    with lock:
+        counters[name] = counters.get(name, 0) + value
+
+
+def get_report():
+    """Returns the spans and counters recorded so far.
+
+    The seconds of a span are summed over all of its runs. Spans of phases that run in several threads at once (e.g.
+    the downloads) can therefore add up to more than the wall time.
+    """
+    with lock:
+        return {'wall_seconds': round(time.perf_counter() - started, 6),
+                'spans': {name: {'count': n, 'seconds': round(total, 6), 'max_seconds': round(longest, 6)}
+                          for name, (n, total, longest) in sorted(spans.items())},
+                'counters': dict(sorted(counters.items()))}
+
+
+def write_report(path):
+    """Writes the report as JSON to path."""
+    with open(path, 'w') as f:
+        json.dump(get_report(), f, indent=2)
+        f.write('\n')
+
+
+def start_cprofile():
+    """Starts cProfile for the main thread. Unlike the spans, it slows everything down and is only used on request."""
+    global profiler
+
+    profiler = cProfile.Profile()
+    profiler.enable()
+
+
+def stop_cprofile(path):
+    """Stops cProfile and dumps its statistics to path, which can be read with pstats or snakeviz."""
+    global profiler
+
+    if profiler is None:
+        return
+
+    profiler.disable()
+    profiler.dump_stats(path)
+    profiler = None
@@ -1,19 +1,44 @@
+import functools
 import struct
 import base64
 
+# A rollover only involves a handful of keys, which are seen in millions of answers
+KEYID_CACHE_SIZE = 1024
 
+
+@functools.lru_cache(maxsize=KEYID_CACHE_SIZE)
 def calc_keyid(flags, protocol, algorithm, dnskey):
     """Returns the DNSKEY key ID."""
 
     st = struct.pack('!HBB', int(flags), int(protocol), int(algorithm))
     st += base64.b64decode(dnskey)
 
-    cnt = 0
-    for idx in range(len(st)):
-        s = struct.unpack('B', st[idx:idx + 1])[0]
-        if (idx % 2) == 0:
-            cnt += s << 8
-        else:
-            cnt += s
+    return calc_keyid_wire(st)
+
+
+@functools.lru_cache(maxsize=KEYID_CACHE_SIZE)
+def calc_keyid_wire(st):
+    """Returns the key ID of a DNSKEY in wire format (RDATA)."""
+
+    # Checksum of RFC 4034, Appendix B: bytes at even positions are the high byte of a 16 bit word
+    cnt = (sum(st[0::2]) << 8) + sum(st[1::2])
 
     return ((cnt & 0xFFFF) + (cnt >> 16)) & 0xFFFF
+
+
+RETURN_CODES = {'NOERROR': 0, 'FORMERR': 1, 'SERVFAIL': 2, 'NXDOMAIN': 3, 'NOTIMP': 4, 'REFUSED': 5, 'YXDOMAIN': 6,
+                'YXRRSET': 7, 'NXRRSET': 8, 'NOTAUTH': 9, 'NOTZONE': 10, 'BADVERS': 16, 'BADCOOKIE': 23}
+
+RETURN_CODE_NAMES = {code: name for name, code in RETURN_CODES.items()}
+
+
+def return_code_to_int(return_code):
+    """Returns the numeric value of a DNS return code (e.g. 'SERVFAIL')."""
+
+    return RETURN_CODES.get(return_code, return_code)
+
+
+def return_code_to_text(return_code):
+    """Returns the name of a numeric DNS return code."""
+
+    return RETURN_CODE_NAMES.get(return_code, return_code)
@@ -1,19 +1,34 @@
 import datetime as dt
+import json
+import queue
+import random
 import time
 import logging
-from ripe.atlas.cousteau import Dns, AtlasSource, AtlasCreateRequest, AtlasStopRequest, AtlasResultsRequest
-from misc.config import config
+from concurrent.futures import ThreadPoolExecutor
+import requests
+from ripe.atlas.cousteau import Dns, AtlasSource, AtlasCreateRequest, AtlasStopRequest, AtlasResultsRequest, Measurement
+from ripe.atlas.cousteau.exceptions import APIResponseError
+from misc.config import config, get_zone_section
+from misc import profiling
 import database
 
+# HTTP status codes of RIPE Atlas errors that go away by themselves: rate limits and temporarily unavailable servers
+TRANSIENT_STATUS_CODES = {429, 500, 502, 503, 504}
 
-def get_targets_from_config(ipv, child=True):
+# Statuses of RIPE Atlas measurements that do not run anymore: stopped, forced to stop, no suitable probes, failed and
+# archived
+STOPPED_STATUS_IDS = {4, 5, 6, 7, 8}
+
+
+def get_targets_from_config(ipv, zone, child=True):
     targets = []
     relationship = 'CHILDREN'
     if not child:
         relationship = 'PARENTS'
 
-    for ns in config[relationship]:
-        for ip in config[relationship][ns].split(','):
+    name_servers = get_zone_section(relationship, zone)
+    for ns in name_servers:
+        for ip in name_servers[ns].split(','):
             if ':' in ip and ipv == 6:
                 targets.append(ip.strip())
             elif ':' not in ip and ipv == 4:
@@ -22,33 +37,33 @@ def get_targets_from_config(ipv, child=True):
     return targets
 
 
-def create_measurements(monitoring_goal, query_type, start_date, stop_date):
-    """Creates new RIPE Atlas measurements and submits it via the RIPE Atlas API."""
+def create_measurements(monitoring_goal, query_type, zone, start_date, stop_date):
+    """Creates new RIPE Atlas measurements of a zone and submits it via the RIPE Atlas API."""
 
     measurements = []
     targets = []
     if monitoring_goal == 'pubdelay':
 
         if query_type == 'dnskey' or query_type == 'rrsig':
-            targets_ipv4 = get_targets_from_config(4)
-            targets_ipv6 = get_targets_from_config(6)
+            targets_ipv4 = get_targets_from_config(4, zone)
+            targets_ipv6 = get_targets_from_config(6, zone)
 
         else:
 
-            targets_ipv4 = get_targets_from_config(4, child=False)
-            targets_ipv6 = get_targets_from_config(6, child=False)
+            targets_ipv4 = get_targets_from_config(4, zone, child=False)
+            targets_ipv6 = get_targets_from_config(6, zone, child=False)
 
         for target in targets_ipv4:
             if len(target) > 0:
                 targets.append(target.strip())
                 measurements.append(
-                    create_measurement(monitoring_goal, target.strip(), query_type.upper(), 4, False, False))
+                    create_measurement(monitoring_goal, zone, target.strip(), query_type.upper(), 4, False, False))
 
         for target in targets_ipv6:
             if len(target) > 0:
                 targets.append(target.strip())
                 measurements.append(
-                    create_measurement(monitoring_goal, target.strip(), query_type.upper(), 6, False, False))
+                    create_measurement(monitoring_goal, zone, target.strip(), query_type.upper(), 6, False, False))
 
         query_types = [query_type] * len(targets)
 
@@ -56,23 +71,22 @@ def create_measurements(monitoring_goal, query_type, start_date, stop_date):
         query_types = [query_type] * 4
         targets = [4, 6, 4, 6]
 
-        measurements.append(create_measurement(monitoring_goal, None, query_type.upper(), 4, True, False))
-        measurements.append(create_measurement(monitoring_goal, None, query_type.upper(), 6, True, False))
+        measurements.append(create_measurement(monitoring_goal, zone, None, query_type.upper(), 4, True, False))
+        measurements.append(create_measurement(monitoring_goal, zone, None, query_type.upper(), 6, True, False))
 
     if monitoring_goal == 'trustchain':
         query_types = ['valid', 'valid', 'bogus', 'bogus']
         targets = [4, 6, 4, 6]
 
+        settings = get_zone_section('MEASUREMENTS', zone)
         measurements.append(
-            create_measurement(monitoring_goal, config['MEASUREMENTS']['trust_chain_valid'], 'A', 4, True, True))
+            create_measurement(monitoring_goal, zone, settings['trust_chain_valid'], 'A', 4, True, True))
         measurements.append(
-            create_measurement(monitoring_goal, config['MEASUREMENTS']['trust_chain_valid'], 'AAAA', 6, True,
-                               True))
+            create_measurement(monitoring_goal, zone, settings['trust_chain_valid'], 'AAAA', 6, True, True))
         measurements.append(
-            create_measurement(monitoring_goal, config['MEASUREMENTS']['trust_chain_bogus'], 'A', 4, True, True))
+            create_measurement(monitoring_goal, zone, settings['trust_chain_bogus'], 'A', 4, True, True))
         measurements.append(
-            create_measurement(monitoring_goal, config['MEASUREMENTS']['trust_chain_bogus'], 'AAAA', 6, True,
-                               True))
+            create_measurement(monitoring_goal, zone, settings['trust_chain_bogus'], 'AAAA', 6, True, True))
 
     # Define timing of measurements
     if start_date is None:
@@ -93,74 +107,255 @@ def create_measurements(monitoring_goal, query_type, start_date, stop_date):
     sources = create_source()
 
     bill_to = config['RIPE']['bill_to']
-
     if bill_to is not None:
         logging.info(f'Charge credits to {bill_to}.')
-        atlas_request = AtlasCreateRequest(
-            start_time=start_date,
-            stop_time=stop_date,
-            key=config['RIPE']['api_key'],
-            measurements=measurements,
-            sources=[sources],
-            bill_to=bill_to
-        )
-
-    else:
-        atlas_request = AtlasCreateRequest(
-            start_time=start_date,
-            stop_time=stop_date,
-            key=config['RIPE']['api_key'],
-            measurements=measurements,
-            sources=[sources],
-        )
 
-    is_success, response = atlas_request.create()
+    def create_chunk(chunk):
+        request_args = dict(start_time=start_date,
+                            stop_time=stop_date,
+                            key=config['RIPE']['api_key'],
+                            measurements=[measurements[i] for i in chunk],
+                            sources=[sources])
+        if bill_to is not None:
+            request_args['bill_to'] = bill_to
+
+        name = f'Creating measurements {chunk.start + 1} to {chunk.stop} of {len(measurements)}'
+        return submit_request(AtlasCreateRequest(**request_args), name, idempotent=False)
+
+    # Long lists of targets are created in several requests, which are sent in parallel
+    chunk_size = config['RIPE'].getint('create_chunk_size', fallback=10)
+    chunks = [range(i, min(i + chunk_size, len(measurements))) for i in range(0, len(measurements), chunk_size)]
+    outcomes = run_requests(create_chunk, chunks)
+
+    # Measurements are stored from this thread only, as the DB connection belongs to it
+    created = 0
+    for chunk, (is_success, response) in outcomes.items():
+        if is_success:
+            for i, msm_id in zip(chunk, response['measurements']):
+                database.init_measurement(msm_id, monitoring_goal, query_types[i], targets[i], zone)
+            created += len(response['measurements'])
+        else:
+            print(f'Could not create measurements {chunk.start + 1} to {chunk.stop}. RIPE Atlas API Error:', response)
 
-    if is_success:
+    if created == len(measurements):
         print('Measurements created successfully.')
-        for i in range(len(response['measurements'])):
-            database.init_measurement(response['measurements'][i], monitoring_goal, query_types[i], targets[i])
     else:
-        print('RIPE Atlas API Error:', response)
+        print(f'Created {created} of {len(measurements)} measurements.')
 
-    return is_success
+    return created == len(measurements)
 
 
-def stop_measurements(monitoring_goal, query_type):
-    """Stops running RIPE Atlas measurements."""
+def stop_measurements(monitoring_goal, query_type, zone):
+    """Stops running RIPE Atlas measurements of a zone in parallel.
 
-    msm_ids, msm_attributes = database.get_measurements(monitoring_goal, query_type, True)
-    success_counter = 0
+    Returns {msm_id: (is_success, response)}. Measurements that could not be stopped stay running in the DB, so that
+    stopping them can be tried again.
+    """
+    msm_ids, msm_attributes = database.get_measurements(monitoring_goal, query_type, True, zone)
 
-    for msm_id in msm_ids:
-        atlas_request = AtlasStopRequest(msm_id=msm_id, key=config['RIPE']['api_key'])
+    def stop(msm_id):
+        is_success, response = submit_request(AtlasStopRequest(msm_id=msm_id, key=config['RIPE']['api_key']),
+                                              f'Stopping {msm_id}')
 
-        is_success, response = atlas_request.create()
-        # print(is_success, response)
+        # A retried request fails if an earlier try stopped the measurement, but its response was lost
+        if not is_success and is_stopped(msm_id):
+            return True, response
+
+        return is_success, response
+
+    outcomes = run_requests(stop, msm_ids)
+
+    for msm_id, (is_success, response) in outcomes.items():
         if is_success:
             database.stop_measurement(msm_id)
-            success_counter += 1
 
-    if success_counter == len(msm_ids):
-        return True
-    else:
+    return outcomes
+
+
+def is_stopped(msm_id):
+    """Checks if a RIPE Atlas measurement does not run anymore. Returns False if its status cannot be fetched."""
+    try:
+        measurement = Measurement(id=msm_id, key=config['RIPE']['api_key'])
+    except APIResponseError:
         return False
 
+    return measurement.status_id in STOPPED_STATUS_IDS
+
+
+def is_transient(response, idempotent):
+    """Checks if a failed request to the RIPE Atlas API can be sent again.
 
-def collect_measurement_results(monitoring_goal, query_type, start_date, stop_date):
-    """Collects measurement results from RIPE Atlas."""
-    msm_data = []
-    msm_ids, msm_attributes = database.get_measurements(monitoring_goal, query_type, None)
+    For connection errors, cousteau returns the arguments of the exception instead of an error response, and for
+    responses that are not JSON (e.g. the error pages of a proxy) their text. They are only retried for idempotent
+    requests, as the request might have been processed. The same goes for server errors, while rate limited requests
+    are rejected before anything is done.
+    """
+    if isinstance(response, (tuple, str)):
+        return idempotent
+
+    status = response.get('error', {}).get('status') if isinstance(response, dict) else None
+
+    return status == 429 or (idempotent and status in TRANSIENT_STATUS_CODES)
+
+
+def submit_request(atlas_request, name, idempotent=True):
+    """Sends a request to the RIPE Atlas API and retries it with exponential backoff while the error is transient.
+    Returns (is_success, response) of the last try."""
+    retries = config['RIPE'].getint('request_retries', fallback=4)
+    backoff = config['RIPE'].getfloat('request_backoff', fallback=2)
+
+    for attempt in range(retries + 1):
+        is_success, response = atlas_request.create()
+        if is_success or attempt == retries or not is_transient(response, idempotent):
+            return is_success, response
+
+        # Jitter keeps requests that were rate limited together from being retried at the same time
+        delay = backoff * 2 ** attempt * random.uniform(1, 1.5)
+        logging.warning(f'{name} failed: {response}. Retrying in {delay:.1f} s')
+        profiling.count('ripe.retries')
+        time.sleep(delay)
+
+
+def run_requests(function, items):
+    """Calls function (which sends requests to the RIPE Atlas API) for every item with at most 'request_workers'
+    requests at a time. Returns {item: result}."""
+    if len(items) == 0:
+        return {}
+
+    workers = min(config['RIPE'].getint('request_workers', fallback=4), len(items))
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        return dict(zip(items, executor.map(function, items)))
+
+
+def stream_results(msm_id, start, stop):
+    """Yields the results of one measurement one by one while they are downloaded from RIPE Atlas."""
+    logging.info(f'Fetching measurements from RIPE for {msm_id}')
+    logging.info(f'Start date: {start}')
+
+    atlas_request = AtlasResultsRequest(msm_id=msm_id, start=start, stop=stop)
+    atlas_request.build_url()
+
+    # With format=txt, RIPE Atlas returns one JSON encoded result per line. This way, the results can be decoded as
+    # they arrive instead of loading the whole response into memory first.
+    http_method_args = dict(atlas_request.http_method_args)
+    http_method_args['params'] = dict(http_method_args['params'], format='txt')
+
+    # Counted once per download, as the lines are too many to update the counters for each of them
+    results = 0
+    size = 0
+    try:
+        with requests.get(atlas_request.url, stream=True, **http_method_args) as response:
+            response.raise_for_status()
+
+            for line in response.iter_lines(chunk_size=64 * 1024):
+                if line:
+                    results += 1
+                    size += len(line)
+                    yield json.loads(line)
+
+    finally:
+        profiling.count('ripe.results', results)
+        profiling.count('ripe.bytes', size)
+
+
+def fetch_results(msm_id, kwargs, batches, batch_size, failed):
+    """Downloads the results of one measurement and puts them in batches into the queue. If the download fails, the
+    measurement is added to failed."""
+    batch = []
+    start = time.perf_counter()
+    try:
+        for result in stream_results(**kwargs):
+            batch.append(result)
+            if len(batch) >= batch_size:
+                batches.put((msm_id, batch))
+                batch = []
+
+        if len(batch) > 0:
+            batches.put((msm_id, batch))
+
+    except Exception as e:
+        logging.error(f'Fetching measurements for {msm_id} failed: {e}')
+        failed.add(msm_id)
+
+    finally:
+        # Includes the time spent waiting for the consumer while the queue is full
+        profiling.add_time('ripe.download', time.perf_counter() - start)
+        # Tells the consumer that this measurement is done
+        batches.put((msm_id, None))
+
+
+def fetch_measurement_results(fetch_jobs, failed):
+    """Downloads the results of several measurements concurrently.
+
+    Yields (msm_id, results) batches in the order in which they arrive, so that the caller can store them one after
+    the other while the downloads are still running. The queue between the downloads and the caller is bounded, so
+    that only a few batches are held in memory at any time. Measurements whose download failed are added to failed;
+    the batches that were yielded before the failure are complete results nonetheless.
+    """
+    if len(fetch_jobs) == 0:
+        return
+
+    workers = min(config['RIPE'].getint('fetch_workers', fallback=8), len(fetch_jobs))
+    batch_size = config['RIPE'].getint('results_batch_size', fallback=1000)
+    batches = queue.Queue(maxsize=workers * 2)
+
+    with ThreadPoolExecutor(max_workers=workers) as executor:
+        for msm_id, kwargs in fetch_jobs.items():
+            executor.submit(fetch_results, msm_id, kwargs, batches, batch_size, failed)
+
+        running = len(fetch_jobs)
+        try:
+            while running > 0:
+                msm_id, results = batches.get()
+                if results is None:
+                    running -= 1
+                else:
+                    yield msm_id, results
+
+        finally:
+            # Unblocks the remaining downloads if the caller stops early
+            while running > 0:
+                if batches.get()[1] is None:
+                    running -= 1
+
+
+def collect_measurement_results(monitoring_goal, query_type, zone, start_date, stop_date, fetch=True):
+    """Collects measurement results from RIPE Atlas and stores them in the DB.
+
+    Returns the IDs of the measurements and the time frame (as timestamps) to analyze. Without fetch, only the stored
+    results are analyzed (e.g. if the daemon keeps the DB up to date).
+    """
+    msm_ids, msm_attributes = database.get_measurements(monitoring_goal, query_type, None, zone)
     if start_date is None:
         stop_date = dt.datetime.now(dt.UTC)
         start_date = stop_date - dt.timedelta(minutes=140)
     if stop_date is None:
         stop_date = dt.datetime.now(dt.UTC)
 
+    if fetch:
+        with profiling.span('ripe.fetch_and_store'):
+            failed = store_new_results(msm_ids, msm_attributes, stop_date)
+
+        # Every result up to stop_date is stored now, so bins that closed before can be aggregated. Bins are not
+        # closed while results of a measurement are missing, as they would not be aggregated again.
+        if len(failed) == 0:
+            database.update_rollup(monitoring_goal, query_type, zone, msm_ids, stop_date.timestamp())
+        else:
+            logging.warning(f'Results of {", ".join(str(msm_id) for msm_id in sorted(failed))} could not be fetched. '
+                            f'The state is incomplete')
+
+    return msm_ids, start_date.timestamp(), stop_date.timestamp()
+
+
+def store_new_results(msm_ids, msm_attributes, stop_date):
+    """Downloads the results of measurements that are not stored yet (up to stop_date) and stores them in the DB.
+
+    Returns the set of measurements whose results could not be downloaded.
+    """
+    fetch_jobs = {}
     for msm_id in msm_ids:
-        query_type = msm_attributes[msm_id][1]
-        latest_ts = database.get_latest_stored_data(
-            msm_id, monitoring_goal, query_type, msm_attributes[msm_id][2], msm_attributes[msm_id][3])
+        monitoring_goal, query_type, target, start_ts, zone = msm_attributes[msm_id]
+        latest_ts = database.get_latest_stored_data(msm_id, monitoring_goal, query_type, target, zone, start_ts)
 
         # Check if last stored measurement is older than stop data
         fetch_from_ripe = False
@@ -175,58 +370,62 @@ def collect_measurement_results(monitoring_goal, query_type, start_date, stop_da
         else:
             fetch_from_ripe = True
             # If DB is empty, fetch data from the start
-            ripe_start_date = msm_attributes[msm_id][3]
+            ripe_start_date = start_ts
 
         if fetch_from_ripe:
-            logging.info(f'Fetching measurements from RIPE for {msm_id}')
-            logging.info(f'Start date: {dt.datetime.fromtimestamp(ripe_start_date, dt.UTC)}')
-            kwargs = {
+            fetch_jobs[msm_id] = {
                 "msm_id": msm_id,
                 "start": dt.datetime.fromtimestamp(ripe_start_date, dt.UTC),
                 "stop": stop_date
             }
 
-            is_success, results = AtlasResultsRequest(**kwargs).create()
+    # Downloads run in parallel, but results are stored one measurement at a time to avoid contention on the DB
+    failed = set()
+    for msm_id, results in fetch_measurement_results(fetch_jobs, failed):
+        monitoring_goal, query_type, target, _, zone = msm_attributes[msm_id]
+        database.store_measurements_in_db(msm_id, monitoring_goal, query_type, target, zone, results)
 
-            if is_success:
-                database.store_measurements_in_db(msm_id, monitoring_goal, query_type, msm_attributes[msm_id][2],
-                                                  results)
+    return failed
 
-        msm_data += database.get_stored_measurements(msm_id, monitoring_goal, query_type, msm_attributes[msm_id][2],
-                                                     start_date.timestamp(), stop_date.timestamp())
 
-    return msm_data
+def get_measurement_interval(monitoring_goal, query_type, zone):
+    """Returns how often (in seconds) the probes of a measurement query."""
+    if monitoring_goal == 'trustchain':
+        return int(get_zone_section('TTLS', zone)['ttl_dnskey']) / 2
+    elif monitoring_goal == 'propdelay':
+        return int(get_zone_section('TTLS', zone)['ttl_' + query_type])
+
+    return int(get_zone_section('MEASUREMENTS', zone)['msm_frequency_publication_delay'])
 
 
-def create_measurement(monitoring_goal, target, query_type, af, use_probe_resolver, monitor_trust_chain):
+def create_measurement(monitoring_goal, zone, target, query_type, af, use_probe_resolver, monitor_trust_chain):
     """Creates one single DNS measurement."""
 
     if use_probe_resolver:
         # Monitor Trust Chain
         if monitor_trust_chain:
-            description = config['ROLLOVER']['ZONE'] + '_' + monitoring_goal + '_' + target + '_' + str(
+            description = zone + '_' + monitoring_goal + '_' + target + '_' + str(
                 int(time.time()))
             dns = Dns(af=af,
                       use_probe_resolver=True,
                       query_class='IN',
                       query_type=query_type,
                       query_argument=target,
-                      interval=int(config['TTLS']['ttl_dnskey']) / 2,
-                      spread=int(config['TTLS']['ttl_dnskey']) / 2 - 20,
+                      interval=get_measurement_interval(monitoring_goal, query_type, zone),
+                      spread=get_measurement_interval(monitoring_goal, query_type, zone) - 20,
                       udp_payload_size=1232,
                       description=description)
 
         # Monitor Propagation Delay
         else:
-            description = config['ROLLOVER'][
-                              'ZONE'] + '_' + monitoring_goal + '_' + query_type + '_use_probe_resolver_' + str(
+            description = zone + '_' + monitoring_goal + '_' + query_type + '_use_probe_resolver_' + str(
                 int(time.time()))
-            interval = int(config['TTLS']['ttl_' + query_type])
+            interval = get_measurement_interval(monitoring_goal, query_type, zone)
             dns = Dns(af=af,
                       use_probe_resolver=True,
                       query_class='IN',
                       query_type=query_type,
-                      query_argument=config['ROLLOVER']['ZONE'],
+                      query_argument=zone,
                       interval=interval,
                       spread=interval - 20,
                       udp_payload_size=1232,
@@ -234,15 +433,14 @@ def create_measurement(monitoring_goal, target, query_type, af, use_probe_resolv
 
     # Monitor Publication Delay 
     else:
-        description = config['ROLLOVER']['ZONE'] + '_' + monitoring_goal + '_' + query_type + '_' + target + '_' + str(
-            int(time.time()))
+        description = zone + '_' + monitoring_goal + '_' + query_type + '_' + target + '_' + str(int(time.time()))
         dns = Dns(af=af,
                   target=target,
                   query_class='IN',
                   query_type=query_type,
-                  query_argument=config['ROLLOVER']['ZONE'],
-                  interval=int(config['MEASUREMENTS']['msm_frequency_publication_delay']),
-                  spread=int(config['MEASUREMENTS']['msm_frequency_publication_delay']) - 20,
+                  query_argument=zone,
+                  interval=get_measurement_interval(monitoring_goal, query_type, zone),
+                  spread=get_measurement_interval(monitoring_goal, query_type, zone) - 20,
                   udp_payload_size=1232,
                   description=description)
 
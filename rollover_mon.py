@@ -1,8 +1,9 @@
 import logging
 from datetime import datetime
-import analysis
+import database
 import ripe_interface
-from misc.config import config
+from misc.config import config, get_default_zone, get_zones
+from misc import profiling
 from pathlib import Path
 
 from misc.argparser import parser
@@ -19,15 +20,21 @@ def parse_args(args):
     record = None
     action = None
     json_output = False
+    json_format = 'json'
     start_date = None
     stop_date = None
     plot = None
     silent = False
+    fetch = True
+    stream = False
+    zone = get_default_zone()
 
     if (monitoring_target != "pubdelay" and monitoring_target != "propdelay"
-            and monitoring_target != "trustchain" and monitoring_target != 'groundtruth'):
-        print("Monitoring target must be either 'pubdelay', 'propdelay', 'trustchain' or 'groundtruth'.")
-        raise AttributeError("Monitoring target must be either 'pubdelay', 'propdelay', 'trustchain' or 'groundtruth'.")
+            and monitoring_target != "trustchain" and monitoring_target != 'groundtruth'
+            and monitoring_target != 'daemon'):
+        print("Monitoring target must be either 'pubdelay', 'propdelay', 'trustchain', 'groundtruth' or 'daemon'.")
+        raise AttributeError(
+            "Monitoring target must be either 'pubdelay', 'propdelay', 'trustchain', 'groundtruth' or 'daemon'.")
 
     if monitoring_target == "pubdelay" or monitoring_target == "propdelay":
         if args.record is None:
@@ -41,14 +48,17 @@ def parse_args(args):
                 raise AttributeError(
                     "'record' must be 'dnskey' or 'ds' if 'target' is 'pubdelay' or 'propdelay'")
 
-    if monitoring_target != 'groundtruth':
+    if monitoring_target != 'groundtruth' and monitoring_target != 'daemon':
         if args.start is True:
             action = 'start'
         elif args.stop is True:
             action = 'stop'
         elif args.status is True:
             action = 'status'
-            json_output = args.json
+            json_output = args.json or args.ndjson
+            if args.ndjson:
+                json_format = 'ndjson'
+            fetch = not args.no_fetch
         else:
             print("Action required")
             raise AttributeError("Action required")
@@ -72,41 +82,86 @@ def parse_args(args):
     if args.silent is True:
         silent = True
 
-    return monitoring_target, record, action, json_output, start_date, stop_date, plot, silent
+    if args.zone is not None:
+        zone = args.zone
+        if zone not in get_zones():
+            print(f"'zone' must be one of the configured zones: {', '.join(get_zones())}")
+            raise AttributeError(f"'zone' must be one of the configured zones: {', '.join(get_zones())}")
 
+    if monitoring_target == 'daemon':
+        stream = args.stream
 
-def main():
-    logging.basicConfig(level=log_level_info[config['OUTPUT']['loglevel']])
+    return (monitoring_target, record, action, json_output, json_format, start_date, stop_date, plot, silent, fetch,
+            stream, zone)
 
-    Path(config['OUTPUT']['figures']+'/servers').mkdir(parents=True, exist_ok=True)
 
+def main():
+    logging.basicConfig(level=log_level_info[config['OUTPUT']['loglevel']])
 
     args = parser.parse_args()
     try:
-        monitoring_target, record, action, json_output, start_date, stop_date, plot, silent = parse_args(args)
+        (monitoring_target, record, action, json_output, json_format, start_date, stop_date, plot, silent, fetch,
+         stream, zone) = parse_args(args)
     except Exception as e:
         print(e)
         return
 
-    if action == 'start':
-        ripe_interface.create_measurements(monitoring_target, record, start_date, stop_date)
+    if args.cprofile is not None:
+        profiling.start_cprofile()
+
+    try:
+        run(monitoring_target, record, action, json_output, json_format, start_date, stop_date, fetch, stream,
+            args.output, zone)
+    except database.CompactedRollupError as e:
+        print(e)
+
+    finally:
+        if args.cprofile is not None:
+            profiling.stop_cprofile(args.cprofile)
+        if args.profile is not None:
+            profiling.write_report(args.profile)
+
+
+def run(monitoring_target, record, action, json_output, json_format, start_date, stop_date, fetch, stream, output,
+        zone):
+    # pandas, matplotlib and the stream client are only imported by the actions that need them, which keeps the start
+    # up of the other actions fast
+    # The daemon keeps the results of every zone up to date
+    if monitoring_target == 'daemon':
+        import daemon
+        daemon.run_daemon(stream)
+
+    elif action == 'start':
+        ripe_interface.create_measurements(monitoring_target, record, zone, start_date, stop_date)
 
     elif action == 'stop':
-        success = ripe_interface.stop_measurements(monitoring_target, record)
-        if success:
+        outcomes = ripe_interface.stop_measurements(monitoring_target, record, zone)
+        failed = {msm_id: response for msm_id, (is_success, response) in outcomes.items() if not is_success}
+        if len(outcomes) == 0:
+            print('No measurement running.')
+        elif len(failed) == 0:
             print('Every measurement stopped successfully.')
         else:
-            print('Could not stop measurements. No measurement running or try again.')
+            for msm_id, response in failed.items():
+                print(f'Could not stop measurement {msm_id}:', response)
+            print(f'Stopped {len(outcomes) - len(failed)} of {len(outcomes)} measurements. Try again to stop the rest.')
 
     elif action == 'status':
-        results = ripe_interface.collect_measurement_results(monitoring_target, record, start_date, stop_date)
-        if results is not None:
-            analysis.get_state(results, monitoring_target, details=json_output, figure=True)
+        import analysis
+        Path(analysis.get_figures_dir(zone) + '/servers').mkdir(parents=True, exist_ok=True)
+
+        msm_ids, start_ts, stop_ts = ripe_interface.collect_measurement_results(monitoring_target, record, zone,
+                                                                                start_date, stop_date, fetch)
+        analysis.get_state(msm_ids, start_ts, stop_ts, monitoring_target, record, details=json_output, figure=True,
+                           json_format=json_format, output=output, zone=zone)
 
     elif monitoring_target == 'groundtruth':
-        results = ripe_interface.collect_measurement_results('trustchain', record, start_date, stop_date)
-        if results is not None:
-            analysis.get_state(results, 'trustchain', details=False, figure=False, groundtruth=True)
+        import analysis
+
+        msm_ids, start_ts, stop_ts = ripe_interface.collect_measurement_results('trustchain', record, zone,
+                                                                                start_date, stop_date)
+        analysis.get_state(msm_ids, start_ts, stop_ts, 'trustchain', record, details=False, figure=False,
+                           groundtruth=True, zone=zone)
 
 
 if __name__ == '__main__':